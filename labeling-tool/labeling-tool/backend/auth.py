@@ -1,13 +1,27 @@
 # auth.py
 import time
+import base64
+import hashlib
+import hmac
+import json
+import math
+import threading
+from collections import OrderedDict
 from fastapi import HTTPException, Header, Depends
-import jwt
-from jwt import PyJWTError
 from pydantic import BaseModel
 import os
 
 SECRET_KEY = os.getenv("SECRET_KEY", "supersecret123")
 ALGORITHM = "HS256"
+SECRET_KEY_BYTES = SECRET_KEY.encode()
+HEADER_B64 = b"eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9"  # {"alg":"HS256","typ":"JWT"}
+
+# LRU of verified token payloads, keyed by the raw token string.
+# Entries live until min(token exp, now + TOKEN_CACHE_TTL); failures are never cached.
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "30"))
+TOKEN_CACHE_MAX = 10000
+_token_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_token_cache_lock = threading.Lock()
 
 class LoginRequest(BaseModel):
     username: str
@@ -17,9 +31,60 @@ class LoginResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
 
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+def _sign(signing_input: bytes) -> bytes:
+    return hmac.new(SECRET_KEY_BYTES, signing_input, hashlib.sha256).digest()
+
 def create_token(username: str, expires_in: int = 3600):
     payload = {"sub": username, "exp": time.time() + expires_in}
-    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    payload_b64 = _b64encode(json.dumps(payload, separators=(",", ":")).encode())
+    signing_input = HEADER_B64 + b"." + payload_b64
+    return (signing_input + b"." + _b64encode(_sign(signing_input))).decode()
+
+def decode_token(token: str) -> dict:
+    """
+    Minimal HS256 JWT check: fixed header, constant-time signature compare, exp.
+    Raises ValueError on any malformed, forged or expired token.
+    """
+    header_b64, payload_b64, sig_b64 = token.encode().split(b".")
+    if header_b64 != HEADER_B64:
+        raise ValueError("Unsupported token header")
+    if not hmac.compare_digest(_b64decode(sig_b64), _sign(header_b64 + b"." + payload_b64)):
+        raise ValueError("Signature mismatch")
+    payload = json.loads(_b64decode(payload_b64))
+    exp = payload.get("exp") if isinstance(payload, dict) else None
+    # json.loads accepts NaN/Infinity (and 1e400 -> inf): such an exp would never expire.
+    if not isinstance(exp, (int, float)) or isinstance(exp, bool) or not math.isfinite(exp):
+        raise ValueError("Missing exp claim")
+    if payload["exp"] <= time.time():
+        raise ValueError("Token expired")
+    return payload
+
+def _cache_get(key: str, now: float):
+    with _token_cache_lock:
+        hit = _token_cache.get(key)
+        if hit is None:
+            return None
+        payload, expires_at = hit
+        if expires_at <= now:
+            del _token_cache[key]
+            return None
+        _token_cache.move_to_end(key)
+        return payload
+
+def _cache_put(key: str, payload: dict, now: float):
+    expires_at = min(float(payload.get("exp", now)), now + TOKEN_CACHE_TTL)
+    if expires_at <= now:
+        return
+    with _token_cache_lock:
+        _token_cache[key] = (payload, expires_at)
+        if len(_token_cache) > TOKEN_CACHE_MAX:
+            _token_cache.popitem(last=False)
 
 def verify_token(authorization: str = Header(...)):
     """Dependency for verifying Bearer token"""
@@ -27,9 +92,13 @@ def verify_token(authorization: str = Header(...)):
         scheme, token = authorization.split()
         if scheme.lower() != "bearer":
             raise HTTPException(status_code=401, detail="Invalid auth scheme")
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        now = time.time()
+        payload = _cache_get(token, now)
+        if payload is None:
+            payload = decode_token(token)
+            _cache_put(token, payload, now)
         return payload
-    except (ValueError, PyJWTError):
+    except ValueError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 def login_user(req: LoginRequest):
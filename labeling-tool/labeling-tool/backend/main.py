@@ -2,17 +2,40 @@
 
 # main.py
 import zipfile
+import json
+import hashlib
 import re
 import shutil
 import os
 import time
+import threading
+import asyncio
+import traceback
+from bisect import bisect_left
+import heapq
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
-from typing import List, Dict
-from fastapi import FastAPI, HTTPException, Query, Path as PathParam, Depends, UploadFile, File
+from typing import Callable, List, Dict, Tuple, Optional
+from fastapi import FastAPI, HTTPException, Query, Path as PathParam, Depends, UploadFile, File, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from neo4j import GraphDatabase
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict
+import orjson
+from neo4j import GraphDatabase, READ_ACCESS
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import (
+        FileSystemEventHandler, FileCreatedEvent, FileClosedEvent, FileDeletedEvent,
+        FileMovedEvent, DirDeletedEvent, DirMovedEvent,
+    )
+except ImportError:  # optional: without watchdog, /api/refresh picks up changes
+    Observer = None
+    FileSystemEventHandler = object
 
 from auth import login_user, LoginRequest, LoginResponse, verify_token
 from batches import BATCHES
@@ -21,10 +44,19 @@ from batches import BATCHES
 NEO4J_URI = os.getenv("NEO4J_URI", "bolt://neo4j:7687")
 NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
 NEO4J_PASS = os.getenv("NEO4J_PASS", "example")
+# Per-process Bolt pool; FastAPI's threadpool (40 threads) is the main consumer.
+NEO4J_POOL_SIZE = int(os.getenv("NEO4J_POOL_SIZE", "50"))
+# Seconds a request may wait for a free pooled connection before failing.
+NEO4J_ACQUISITION_TIMEOUT = float(os.getenv("NEO4J_ACQUISITION_TIMEOUT", "30"))
+# Naming the database up front saves the driver a home-database lookup per session.
+NEO4J_DB = os.getenv("NEO4J_DB", "neo4j")
 
 IMAGE_ROOT = os.getenv("IMAGE_ROOT", "/data/images")
 UPLOAD_ROOT = os.getenv("UPLOAD_ROOT", "/data/uploads")
 PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE", "20"))
+UPLOAD_CHUNK_SIZE = 1 << 20
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()] or ["*"]
+SCAN_CACHE_FILE = Path(UPLOAD_ROOT) / "scan_cache.json"
 
 BATCH_DIR = Path(UPLOAD_ROOT) / "labeled"
 NON_LABELED_DIR = Path(UPLOAD_ROOT) / "non_labeled"
@@ -32,70 +64,654 @@ BATCH_DIR.mkdir(parents=True, exist_ok=True)
 NON_LABELED_DIR.mkdir(parents=True, exist_ok=True)
 
 # ---------------- App ----------------
-app = FastAPI(title="Image Labeling API (Neo4j, single :Image label)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup: scan off the event loop, then let the MERGE run in the background
+    # so /api/health answers while a large library is still being synced.
+    global image_watcher, _startup_merge_task, _retrieval_warm_task
+    # Schema first (the MERGEs rely on the path constraint). Done here rather
+    # than at import, so importing main never talks to Neo4j.
+    await asyncio.to_thread(ensure_indexes)
+    await asyncio.to_thread(_load_scan_cache)
+    new_paths = await asyncio.to_thread(rescan_images)
+    print(f"[startup] images found: {len(IMAGE_LIST)} in {IMAGE_ROOT} ({len(new_paths)} new)")
+    seed_next_image_index(IMAGE_LIST)
+    _startup_merge_task = asyncio.create_task(_startup_merge(new_paths))
+    image_watcher = start_image_watcher()
+    if WARM_RETRIEVAL:
+        _retrieval_warm_task = asyncio.create_task(asyncio.to_thread(_warm_retrieval))
+    yield
+    # Shutdown: stop the image watcher, let a still-running startup MERGE stop
+    # after its current chunk, and only then release the Bolt connection pool.
+    # (Cancelling the task alone would not stop its worker thread, which would
+    # then hit the closed driver.)
+    if image_watcher is not None:
+        image_watcher.stop()
+        await asyncio.to_thread(image_watcher.join)  # may be mid-rescan/MERGE
+    if _retrieval_warm_task is not None:
+        _retrieval_warm_task.cancel()  # no driver use; just don't leave it pending
+    _merge_stop.set()
+    if _startup_merge_task is not None:
+        await _startup_merge_task
+    driver.close()
+
+app = FastAPI(
+    title="Image Labeling API (Neo4j, single :Image label)",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    # Auth is a bearer header, not cookies. With "*" the middleware then emits
+    # a static Allow-Origin instead of echoing/matching the Origin per request
+    # ("*" + credentials is rejected by browsers anyway).
+    allow_credentials=CORS_ORIGINS != ["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
 )
 
 # ---------------- Static Images ----------------
 Path(IMAGE_ROOT).mkdir(parents=True, exist_ok=True)
 app.mount("/images", StaticFiles(directory=IMAGE_ROOT), name="images")
-PENDING_NON_LABELED: List[str] = []
 
 # ---------------- Database ----------------
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASS))
+# One driver per process, shared by every request; never build one per call.
+driver = GraphDatabase.driver(
+    NEO4J_URI,
+    auth=(NEO4J_USER, NEO4J_PASS),
+    max_connection_pool_size=NEO4J_POOL_SIZE,
+    connection_acquisition_timeout=NEO4J_ACQUISITION_TIMEOUT,
+    max_connection_lifetime=1800,  # recycle before server/proxy idle cut-offs leave stale sockets
+    keep_alive=True,
+)
 
-def run_query(query: str, params: Dict = {}):
-    with driver.session() as session:
-        return list(session.run(query, params))
+def run_read(query: str, params: Optional[Dict] = None):
+    """
+    Managed read transaction: READ access lets a cluster route it to a
+    follower and the driver retries it on transient errors.
+    """
+    with driver.session(database=NEO4J_DB, default_access_mode=READ_ACCESS) as session:
+        return session.execute_read(lambda tx: list(tx.run(query, params or {})))
 
-def ensure_indexes():
-    # Only one label: :Image
-    run_query("CREATE CONSTRAINT IF NOT EXISTS FOR (i:Image) REQUIRE i.path IS UNIQUE")
+def run_reads(statements: List[tuple]) -> List[list]:
+    """
+    Run several (query, params) reads in one session and one managed read
+    transaction (one BEGIN/COMMIT, consistent snapshot); returns one record
+    list per statement, in order.
+    """
+    def work(tx):
+        return [list(tx.run(query, params or {})) for query, params in statements]
+    with driver.session(database=NEO4J_DB, default_access_mode=READ_ACCESS) as session:
+        return session.execute_read(work)
+
+def run_write(query: str, params: Optional[Dict] = None):
+    """
+    Managed write transaction (retried on transient errors).
+    """
+    with driver.session(database=NEO4J_DB) as session:
+        return session.execute_write(lambda tx: list(tx.run(query, params or {})))
+
+def run_in_transaction(statements: List[tuple]):
+    """
+    Run several (query, params) pairs inside one managed write transaction.
+    """
+    def work(tx):
+        for query, params in statements:
+            tx.run(query, params).consume()
+    with driver.session(database=NEO4J_DB) as session:
+        session.execute_write(work)
+
+# Neo4j caches plans by exact query text, so statements used from several
+# places live here as constants (one plan each). Values always go in as
+# $parameters, never interpolated into the string.
+# Both label lists in one row: one node seek, one statement, one round-trip.
+Q_LABELS = """
+    MATCH (q:Image {path:$q})
+    RETURN [(q)-[:POSITIVE]->(i) | i.path] AS positives,
+           [(q)-[:NEGATIVE]->(i) | i.path] AS negatives
+"""
+
+def read_labels(query_path: str) -> Tuple[List[str], List[str]]:
+    """
+    (positive paths, negative paths) labeled for a query image.
+    """
+    rows = run_read(Q_LABELS, {"q": query_path})
+    if not rows:
+        return [], []
+    return rows[0]["positives"], rows[0]["negatives"]
 
-ensure_indexes()
+# Pending (uploaded, not yet processed) images live in the graph as
+# :Image {pending: true}, so the queue survives restarts and every worker
+# sees the same one.
+Q_PENDING_COUNT = "MATCH (i:Image {pending: true}) RETURN count(i) AS c"
+
+def mark_pending(paths: List[str]):
+    """
+    MERGE :Image nodes for uploaded web paths and flag them pending.
+    """
+    run_write("""
+        UNWIND $paths AS p
+        MERGE (i:Image {path: p})
+        SET i.pending = true
+    """, {"paths": paths})
+
+def pending_images() -> List[str]:
+    return [r["path"] for r in run_read(
+        "MATCH (i:Image {pending: true}) RETURN i.path AS path ORDER BY path")]
+
+def pending_count() -> int:
+    rows = run_read(Q_PENDING_COUNT)
+    return rows[0]["c"] if rows else 0
+
+def clear_pending(paths: List[str]):
+    run_write("""
+        UNWIND $paths AS p
+        MATCH (i:Image {path: p})
+        REMOVE i.pending
+    """, {"paths": paths})
+
+def ensure_indexes():
+    # Only one label: :Image (the uniqueness constraint also backs path lookups)
+    run_write("CREATE CONSTRAINT IF NOT EXISTS FOR (i:Image) REQUIRE i.path IS UNIQUE")
+    # Token lookup indexes let label scans and POSITIVE/NEGATIVE/CONNECTED
+    # type scans (stats summary) seek instead of scanning every node/edge.
+    # Neo4j 5 ships them by default; recreate them if they were dropped.
+    run_write("CREATE LOOKUP INDEX IF NOT EXISTS FOR (n) ON EACH labels(n)")
+    run_write("CREATE LOOKUP INDEX IF NOT EXISTS FOR ()-[r]-() ON EACH type(r)")
+    # Uploaded-but-unprocessed images are flagged i.pending (see mark_pending)
+    run_write("CREATE INDEX image_pending IF NOT EXISTS FOR (i:Image) ON (i.pending)")
 
 # ---------------- Image Scan ----------------
-def scan_images(root: str) -> List[str]:
-    exts = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"})
+IMAGE_EXT_TUPLE = tuple(IMAGE_EXTS)
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "8"))
+WATCH_IMAGES = os.getenv("WATCH_IMAGES", "1") == "1"
+MERGE_BATCH_SIZE = int(os.getenv("MERGE_BATCH_SIZE", "1000"))
+# Concurrent MERGE transactions for large node syncs. Chunks hold disjoint
+# paths and path is unique-constrained, so they don't contend on the same keys.
+MERGE_WORKERS = int(os.getenv("MERGE_WORKERS", "4"))
+MTIME_SLACK_NS = 2_000_000_000  # covers coarse (FAT/SMB/bind-mount) mtime resolution
+
+def is_image_name(name: str) -> bool:
+    # Same result as Path(name).suffix.lower() in IMAGE_EXTS without building a
+    # PurePath per entry. str.endswith(tuple) runs in C and the common
+    # lowercase case allocates nothing; the dot check mirrors suffix
+    # ignoring bare dotfiles like ".png".
+    return ((name.endswith(IMAGE_EXT_TUPLE) or name.lower().endswith(IMAGE_EXT_TUPLE))
+            and (name[0] != "." or name.rfind(".") > 0))
+
+def _scan_dir(dirpath: str, prefix: str, cached: Optional[list] = None):
+    """
+    List one directory with os.scandir.
+    `cached` is this directory's [mtime_ns, files, subdir names] from an earlier
+    scan; if the directory mtime hasn't moved it is reused without listing.
+    Returns (prefix, mtime_ns, image paths relative to the scan root, subdir names).
+    Unreadable directories are skipped, like os.walk does.
+    """
+    try:
+        mtime = os.stat(dirpath).st_mtime_ns
+        if cached is not None and cached[0] == mtime:
+            return prefix, mtime, cached[1], cached[2]
+        files: List[str] = []
+        subdirs: List[str] = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                name = entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(name)
+                elif is_image_name(name):
+                    files.append(prefix + name)
+        if time.time_ns() - mtime < MTIME_SLACK_NS:
+            # Listed in the same timestamp window as the last change: a write
+            # could still land under this mtime, so never reuse this listing.
+            mtime = -1
+        return prefix, mtime, files, subdirs
+    except OSError:
+        return prefix, None, [], []
+
+def scan_images(root: str, workers: int = SCAN_WORKERS,
+                cache: Optional[Dict[str, list]] = None) -> List[str]:
+    """
+    Concurrent BFS over the image tree: each worker scandirs one directory
+    and its subdirectories are submitted back to the pool as new tasks.
+    With workers <= 1 it is a plain iterative stack walk, no pool at all.
+
+    `cache` (prefix -> [mtime_ns, files, subdir names]) lets unchanged
+    directories cost one stat instead of a listing; it is replaced in place
+    with this scan's entries.
+    """
+    prev = cache if cache is not None else {}
+    seen: Dict[str, list] = {}
     files: List[str] = []
-    for base, _, names in os.walk(root):
-        for n in names:
-            if Path(n).suffix.lower() in exts:
-                rel = os.path.relpath(os.path.join(base, n), root)
-                files.append(rel.replace("\\", "/"))
+
+    def collect(result):
+        prefix, mtime, found, subdirs = result
+        if mtime is not None:
+            seen[prefix] = [mtime, found, subdirs]
+        files.extend(found)
+        return [(os.path.join(root, prefix + name), prefix + name + "/") for name in subdirs]
+
+    if workers <= 1:
+        stack = [(root, "")]
+        while stack:
+            d, prefix = stack.pop()
+            stack.extend(collect(_scan_dir(d, prefix, prev.get(prefix))))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = {pool.submit(_scan_dir, root, "", prev.get(""))}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    pending.update(pool.submit(_scan_dir, d, prefix, prev.get(prefix))
+                                   for d, prefix in collect(fut.result()))
+    if cache is not None:
+        cache.clear()
+        cache.update(seen)
     return sorted(files)
 
+# Set at shutdown: MERGE workers stop between chunks (MERGE is idempotent,
+# so the next startup/refresh simply redoes the rest).
+_merge_stop = threading.Event()
+
 def merge_all_images_as_nodes(images: List[str]):
     # MERGE a node for each image under /images
     if not images:
         return
-    # Use UNWIND for efficiency
-    run_query("""
+    # UNWIND in MERGE_BATCH_SIZE chunks, one transaction each, so a large
+    # library doesn't become one giant write transaction that blocks writers.
+    # Several chunks are committed concurrently (MERGE_WORKERS sessions).
+    paths = [f"/images/{p}" for p in images]
+    chunks = [paths[i:i + MERGE_BATCH_SIZE] for i in range(0, len(paths), MERGE_BATCH_SIZE)]
+    query = """
         UNWIND $paths AS p
         MERGE (:Image {path: p})
-    """, {"paths": [f"/images/{p}" for p in images]})
+    """
+
+    def merge_chunks(own: List[List[str]]):
+        with driver.session(database=NEO4J_DB) as session:
+            for chunk in own:
+                if _merge_stop.is_set():
+                    return
+                session.execute_write(lambda tx: tx.run(query, {"paths": chunk}).consume())
+
+    workers = max(1, min(MERGE_WORKERS, len(chunks)))
+    if workers == 1:
+        merge_chunks(chunks)
+        return
+    # Round-robin the chunks so each worker reuses one session for its share.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for f in [pool.submit(merge_chunks, chunks[w::workers]) for w in range(workers)]:
+            f.result()
+
+IMAGE_LIST: Tuple[str, ...] = ()
+IMAGE_LIST_URLS: Tuple[str, ...] = ()  # IMAGE_LIST with the "/images/" prefix applied
+IMAGE_LIST_VERSION = 0  # bumped on every IMAGE_LIST change; keys the /api/session cache
+# (urls, version) published with a single assignment, so lock-free readers
+# never pair one scan's URLs with another scan's version.
+IMAGE_SNAPSHOT: Tuple[Tuple[str, ...], int] = ((), 0)
+_image_list_lock = threading.Lock()
+
+def _publish_image_list(files: Tuple[str, ...], urls: Tuple[str, ...]):
+    # caller holds _image_list_lock
+    global IMAGE_LIST, IMAGE_LIST_URLS, IMAGE_LIST_VERSION, IMAGE_SNAPSHOT
+    IMAGE_LIST, IMAGE_LIST_URLS = files, urls
+    IMAGE_LIST_VERSION += 1
+    IMAGE_SNAPSHOT = (urls, IMAGE_LIST_VERSION)
+
+def set_image_list(files: List[str]):
+    """
+    Replace IMAGE_LIST and precompute its web paths once per scan,
+    so /api/session only slices instead of formatting strings per request.
+    """
+    files = tuple(files)
+    urls = tuple("/images/" + p for p in files)
+    with _image_list_lock:
+        _publish_image_list(files, urls)
 
-IMAGE_LIST: List[str] = scan_images(IMAGE_ROOT)
-merge_all_images_as_nodes(IMAGE_LIST)
-print(f"[startup] images found: {len(IMAGE_LIST)} in {IMAGE_ROOT} (nodes merged)")
+def _image_list_has(rel: str) -> bool:
+    i = bisect_left(IMAGE_LIST, rel)
+    return i < len(IMAGE_LIST) and IMAGE_LIST[i] == rel
+
+def _image_list_add_many(rels) -> bool:
+    """
+    Insert relative paths (e.g. a just-imported ZIP) without a rescan: one
+    O(N + k log k) merge of the sorted additions into IMAGE_LIST.
+    False if every path was already listed.
+    """
+    with _image_list_lock:
+        new = sorted({r for r in rels if not _image_list_has(r)})
+        if not new:
+            return False
+        merged = heapq.merge(zip(IMAGE_LIST, IMAGE_LIST_URLS), ((r, "/images/" + r) for r in new))
+        files, urls = zip(*merged)
+        _publish_image_list(files, urls)
+        return True
+
+def _image_list_remove_many(rels) -> bool:
+    """Drop relative paths in one O(N) pass; False if none was listed."""
+    with _image_list_lock:
+        gone = {r for r in rels if _image_list_has(r)}
+        if not gone:
+            return False
+        kept = [(f, u) for f, u in zip(IMAGE_LIST, IMAGE_LIST_URLS) if f not in gone]
+        files, urls = zip(*kept) if kept else ((), ())
+        _publish_image_list(files, urls)
+        return True
+
+# Seconds of filesystem events collected into one IMAGE_LIST update.
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", "0.5"))
+# inotify reports IN_CLOSE_WRITE, so a new file is listed once it has been
+# written, not when it is created empty; elsewhere on_created has to do.
+WATCH_CLOSE_EVENTS = Observer is not None and Observer.__name__ == "InotifyObserver"
+
+class ImageTreeHandler(FileSystemEventHandler):
+    """
+    Keeps IMAGE_LIST in sync with IMAGE_ROOT from filesystem events. File
+    events are collected for WATCH_DEBOUNCE seconds and applied as one
+    merge, so a k-image import costs one O(N + k log k) update instead of k
+    list rebuilds. Updates take _scan_lock, so a rescan never publishes a
+    listing that predates them.
+    Directory deletes/moves fall back to a rescan since their children
+    don't always get individual events. Any change to the list also drops
+    the cached project stats, as the upload paths do.
+    """
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._pending: Dict[str, bool] = {}  # rel -> exists, latest event wins
+        self._timer: Optional[threading.Timer] = None
+
+    def _rel(self, path: str) -> str:
+        return os.path.relpath(path, IMAGE_ROOT).replace("\\", "/")
+
+    def _queue(self, path: str, exists: bool):
+        if not path or not is_image_name(os.path.basename(path)):
+            return
+        with self._lock:
+            self._pending[self._rel(path)] = exists
+            if self._timer is None:
+                self._timer = threading.Timer(WATCH_DEBOUNCE, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending, self._timer = self._pending, {}, None
+        if not pending:
+            return
+        with _scan_lock:
+            changed = _image_list_remove_many([r for r, e in pending.items() if not e])
+            changed |= _image_list_add_many([r for r, e in pending.items() if e])
+        if changed:
+            invalidate_stats_cache()
+
+    def on_created(self, event):
+        if not event.is_directory and not WATCH_CLOSE_EVENTS:
+            self._queue(event.src_path, True)
+
+    def on_closed(self, event):
+        self._queue(event.src_path, True)
+
+    def _rescan(self):
+        # The rescan advances _scan_cache past whatever it finds, so those
+        # paths must be MERGEd now; a later refresh would not see them as new.
+        try:
+            sync_image_nodes(rescan_images())
+        except Exception:
+            traceback.print_exc()
+        invalidate_stats_cache()
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            self._rescan()
+        else:
+            self._queue(event.src_path, False)
+
+    def on_moved(self, event):
+        # With full inotify events, a move into or out of the tree arrives
+        # with an empty src/dest path.
+        if event.is_directory:
+            self._rescan()
+            return
+        self._queue(event.src_path, False)
+        self._queue(event.dest_path, True)
+
+def start_image_watcher():
+    if Observer is None or not WATCH_IMAGES:
+        print("[startup] image watcher disabled; use POST /api/refresh after changing images")
+        return None
+    # Full events turn moves across the tree boundary into moves (not
+    # creates), so on_created only ever means "file opened for writing".
+    observer = Observer(generate_full_events=True) if WATCH_CLOSE_EVENTS else Observer()
+    observer.daemon = True
+    # Only the events the handler uses; without a filter inotify also
+    # reports every open/read of an image served from /images.
+    observer.schedule(ImageTreeHandler(), IMAGE_ROOT, recursive=True, event_filter=[
+        FileCreatedEvent, FileClosedEvent, FileDeletedEvent, FileMovedEvent,
+        DirDeletedEvent, DirMovedEvent,
+    ])
+    observer.start()
+    return observer
+
+# Per-directory scan results persisted across restarts (see scan_images `cache`)
+_scan_cache: Dict[str, list] = {}
+_scan_lock = threading.Lock()
+
+def _load_scan_cache():
+    try:
+        data = json.loads(SCAN_CACHE_FILE.read_text(encoding="utf-8"))
+        if data.get("root") == IMAGE_ROOT:
+            _scan_cache.update(data.get("dirs", {}))
+    except (OSError, ValueError):
+        pass
+
+def _save_scan_cache():
+    tmp = SCAN_CACHE_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"root": IMAGE_ROOT, "dirs": _scan_cache}), encoding="utf-8")
+    os.replace(tmp, SCAN_CACHE_FILE)
+
+def rescan_images() -> List[str]:
+    """
+    Re-scan IMAGE_ROOT through the directory-mtime cache, publish the result
+    as IMAGE_LIST and return the paths that weren't in the previous scan.
+    The scan cache moves past those paths, so every caller must hand them to
+    sync_image_nodes: no later rescan reports them as new again.
+    """
+    with _scan_lock:
+        before = {p for entry in _scan_cache.values() for p in entry[1]}
+        files = scan_images(IMAGE_ROOT, cache=_scan_cache)
+        _save_scan_cache()
+        set_image_list(files)
+    return [p for p in files if p not in before]
+
+def add_images(rels) -> bool:
+    """
+    List files the app itself just wrote (uploads). Taken under _scan_lock,
+    like the watcher's updates, so a concurrent rescan can't drop them.
+    """
+    with _scan_lock:
+        return _image_list_add_many(rels)
+
+def sync_image_nodes(new_paths: List[str]) -> int:
+    """
+    MERGE :Image nodes for newly scanned paths only. If the graph holds fewer
+    :Image nodes than there are files (count store lookup, e.g. after a DB
+    wipe), fall back to MERGE-ing the whole IMAGE_LIST.
+    Returns how many paths were sent to Neo4j.
+    """
+    rows = run_read("MATCH (i:Image) RETURN count(i) AS c")
+    paths = list(IMAGE_LIST) if rows and rows[0]["c"] < len(IMAGE_LIST) else new_paths
+    merge_all_images_as_nodes(paths)
+    return len(paths)
+
+# Load the CLIP model and run its warm-up (torch.compile, CUDA init) in the
+# background at startup instead of inside the first retrieval request.
+WARM_RETRIEVAL = os.getenv("WARM_RETRIEVAL", "1") == "1"
+_retrieval_warm_task = None
+
+def _warm_retrieval():
+    try:
+        import retrieval
+        retrieval.warmup()
+    except Exception:
+        # Only logged: the endpoints still import retrieval themselves.
+        traceback.print_exc()
+
+READY = False  # set once the startup MERGE has finished (see /api/ready)
+image_watcher = None
+_startup_merge_task = None
+
+async def _startup_merge(new_paths: List[str]):
+    global READY
+    try:
+        merged = await asyncio.to_thread(sync_image_nodes, new_paths)
+        if _merge_stop.is_set():
+            # The scan cache already lists the unmerged paths; dropping it makes
+            # the next startup rescan everything and MERGE it (idempotent).
+            SCAN_CACHE_FILE.unlink(missing_ok=True)
+            print("[startup] :Image MERGE interrupted by shutdown")
+            return
+        READY = True
+        print(f"[startup] {merged} :Image nodes merged; ready")
+    except Exception:
+        traceback.print_exc()
+
+# ---------------- Batches ----------------
+# (body, ETag) pairs: BATCHES[i] pre-serialized for /api/batch/{i}, and the
+# /api/batches/count body. Each is replaced by one assignment in set_batches.
+BATCH_RESPONSES: List[Tuple[bytes, str]] = []
+BATCH_COUNT_RESPONSE: Tuple[bytes, str] = (b"", "")
+BATCH_INDEX: Dict[str, int] = {}  # queryImage -> first batch index holding it
+# Batches (and session pages) can change under the client (process_pending,
+# uploads), so clients may keep them but must revalidate (cheap 304 via ETag).
+BATCH_CACHE_CONTROL = "private, no-cache"
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+def _batch_response(batch) -> Tuple[bytes, str]:
+    body = orjson.dumps(batch)
+    return body, _etag(body)
+
+def set_batches(batches: List[dict], changed: Optional[List[int]] = None):
+    """
+    Replace BATCHES and re-serialize the per-batch response bodies (and
+    their ETags), so the batch endpoints just hand out bytes. Also rebuilds
+    BATCH_INDEX for O(1) lookups by query image.
+    `changed` (ascending indices; the rest match the current BATCHES) limits
+    the re-serialization to those entries.
+    """
+    global BATCHES, BATCH_RESPONSES, BATCH_COUNT_RESPONSE, BATCH_INDEX
+    if changed is None:
+        responses = [_batch_response(b) for b in batches]
+        index: Dict[str, int] = {}
+        for i, b in enumerate(batches):
+            if isinstance(b, dict):
+                index.setdefault(b.get("queryImage"), i)
+    else:
+        responses = list(BATCH_RESPONSES)
+        index = dict(BATCH_INDEX)
+        for i in changed:
+            if i < len(responses):
+                responses[i] = _batch_response(batches[i])
+            else:
+                responses.append(_batch_response(batches[i]))
+            if isinstance(batches[i], dict):
+                index.setdefault(batches[i].get("queryImage"), i)
+    count_body = orjson.dumps({"total": len(batches)})
+    BATCHES = batches
+    BATCH_INDEX = index
+    BATCH_RESPONSES = responses
+    BATCH_COUNT_RESPONSE = (count_body, _etag(count_body))
+
+BATCH_FILE = Path(__file__).resolve().parent / "batches.py"
+# Batch changes since the last compaction, one {"index", "batch"} JSON line
+# each (index == current length appends). Folded over batches.py at startup.
+BATCH_LOG_FILE = BATCH_FILE.with_name("batches.jsonl")
+_batches_lock = threading.Lock()  # serializes read-modify-write of BATCHES
+
+def _apply_batch_log(batches: List[dict]) -> List[dict]:
+    """Replay BATCH_LOG_FILE onto batches (in place) and return it."""
+    try:
+        with open(BATCH_LOG_FILE, "rb") as f:
+            for line in f:
+                try:
+                    rec = orjson.loads(line)
+                    i, batch = rec["index"], rec["batch"]
+                except (orjson.JSONDecodeError, KeyError, TypeError):
+                    continue  # torn last line of an interrupted write
+                if i < len(batches):
+                    batches[i] = batch
+                elif i == len(batches):
+                    batches.append(batch)
+    except FileNotFoundError:
+        pass
+    return batches
+
+def save_batches(updates: List[Tuple[int, dict]]):
+    """
+    Persist (index, batch) changes by appending them to BATCH_LOG_FILE and
+    publish them in memory (an index equal to the current length appends).
+    Costs O(changed batches) of serialization and I/O; batches.py itself is
+    only rewritten by compact_batches. Caller holds _batches_lock.
+    """
+    batches = list(BATCHES)
+    for i, batch in updates:
+        if i < len(batches):
+            batches[i] = batch
+        elif i == len(batches):
+            batches.append(batch)
+        else:
+            raise IndexError(f"batch index {i} past the end ({len(batches)})")
+    with open(BATCH_LOG_FILE, "ab") as f:
+        f.write(b"".join(orjson.dumps({"index": i, "batch": b}) + b"\n" for i, b in updates))
+    set_batches(batches, changed=sorted({i for i, _ in updates}))
+
+def compact_batches():
+    """
+    Rewrite batches.py from BATCHES (temp file, then swapped in) and empty
+    the log. Replaying a log that survived a crash here is harmless: every
+    record then rewrites an index with the same batch. Caller holds
+    _batches_lock.
+    """
+    tmp = BATCH_FILE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("BATCHES = ")
+        json.dump(BATCHES, f, indent=2)
+        f.write("\n")
+    os.replace(tmp, BATCH_FILE)
+    BATCH_LOG_FILE.unlink(missing_ok=True)
+
+def cached_json_response(request: Request, body: bytes, etag: str) -> Response:
+    """
+    200 with the pre-serialized body, or an empty 304 when the client's
+    If-None-Match already names this ETag.
+    """
+    headers = {"ETag": etag, "Cache-Control": BATCH_CACHE_CONTROL}
+    inm = request.headers.get("if-none-match")
+    if inm and any(t.strip().removeprefix("W/") in (etag, "*") for t in inm.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+set_batches(_apply_batch_log(list(BATCHES)))
 
 # ---------------- Schemas ----------------
 class SessionResponse(BaseModel):
     queryImage: str
     images: List[str]
 
+# Request bodies are read-only: frozen + ignore unknown keys keeps
+# pydantic v2's validator on its fast path.
 class SaveLabelsBody(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
     queryImage: str
     positives: List[str] = []
     negatives: List[str] = []
 
 class StatsBulkRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
     images: List[str]
 
 class StatsBulkResponse(BaseModel):
@@ -127,47 +743,124 @@ def login(req: LoginRequest):
     return login_user(req)
 
 # ---------------- Health ----------------
+HEALTH_PING_TTL = 1.0
+_last_ping = (0.0, False)  # (monotonic ts, neo4j alive)
+
+def ping_neo4j() -> bool:
+    """
+    Neo4j liveness, re-checked at most once per HEALTH_PING_TTL seconds
+    so frequent health probes don't each cost a Bolt round-trip.
+    """
+    global _last_ping
+    now = time.monotonic()
+    if now - _last_ping[0] > HEALTH_PING_TTL:
+        try:
+            run_read("RETURN 1 as ok")
+            alive = True
+        except Exception:
+            alive = False
+        _last_ping = (now, alive)
+    return _last_ping[1]
+
 @app.get("/api/health")
 def health():
-    try:
-        run_query("RETURN 1 as ok")
-        alive = True
-    except Exception:
-        alive = False
+    alive = ping_neo4j()
     return {"status": "ok", "images": len(IMAGE_LIST), "neo4j": alive, "image_root": IMAGE_ROOT}
 
+@app.get("/api/ready")
+def ready():
+    """
+    Readiness probe: 503 until the startup :Image MERGE has completed.
+    """
+    if not READY:
+        return ORJSONResponse({"ready": False}, status_code=503)
+    return {"ready": True}
+
 @app.post("/api/refresh")
 def refresh():
     """
-    Re-scan /images and MERGE missing :Image nodes (idempotent).
+    Re-scan /images (unchanged directories are skipped via their mtime)
+    and MERGE :Image nodes for the new paths only (idempotent).
+    IMAGE_LIST is normally kept current by the image watcher; this is the
+    on-demand sanity rescan (and the only way when watchdog isn't installed).
+    Also recovers readiness if the startup MERGE failed.
     """
-    global IMAGE_LIST
-    IMAGE_LIST = scan_images(IMAGE_ROOT)
-    merge_all_images_as_nodes(IMAGE_LIST)
+    global READY
+    sync_image_nodes(rescan_images())
+    READY = True
+    invalidate_stats_cache()
     return {"ok": True, "count": len(IMAGE_LIST)}
 
 # ---------------- Session & Labels ----------------
-@app.get("/api/session", response_model=SessionResponse)
-def get_session(offset: int = Query(0, ge=0),
+SESSION_CACHE_MAX = 4096
+# (index, limit) -> (body, ETag) for one IMAGE_SNAPSHOT version only: a newer
+# version empties it, so cached pages never outlive (or pin) their URL tuple.
+_session_cache: "OrderedDict[Tuple[int, int], Tuple[bytes, str]]" = OrderedDict()
+_session_cache_version = 0
+_session_cache_lock = threading.Lock()
+
+def _build_session_page(urls: Tuple[str, ...], index: int, limit: int) -> Tuple[bytes, str]:
+    """
+    Serialized /api/session page for urls[index], with its ETag.
+    """
+    n = len(urls)
+    if n == 0:
+        raise ValueError("no images to page through")
+    start = (index + 1) % n
+    # Same window as urls[start:start+limit] + urls[0:rest] (wraps at most
+    # once), built in one pass over indices without slices or a filter pass.
+    first = min(limit, n - start)
+    total = first + min(n, limit - first)
+    page = [urls[j % n] for j in range(start, start + total) if j % n != index]
+    body = orjson.dumps({"queryImage": urls[index], "images": page})
+    return body, _etag(body)
+
+def _session_page(urls: Tuple[str, ...], version: int, index: int, limit: int) -> Tuple[bytes, str]:
+    """
+    _build_session_page through the page cache. `urls` must be the snapshot
+    `version` came from, so a cached page always matches its key; a request
+    still holding an older snapshot gets an uncached page.
+    """
+    global _session_cache_version
+    key = (index, limit)
+    with _session_cache_lock:
+        if version > _session_cache_version:
+            _session_cache.clear()
+            _session_cache_version = version
+        hit = _session_cache.get(key) if version == _session_cache_version else None
+        if hit is not None:
+            _session_cache.move_to_end(key)
+            return hit
+    page = _build_session_page(urls, index, limit)
+    with _session_cache_lock:
+        if version == _session_cache_version:
+            _session_cache[key] = page
+            if len(_session_cache) > SESSION_CACHE_MAX:
+                _session_cache.popitem(last=False)
+    return page
+
+# The page is pre-serialized, so the model only documents the schema.
+@app.get("/api/session", responses={200: {"model": SessionResponse}})
+def get_session(request: Request,
+                offset: int = Query(0, ge=0),
                 limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=200),
                 user=Depends(verify_token)):
-    if not IMAGE_LIST:
+    # One snapshot for the emptiness check, the index, the page and its key.
+    urls, version = IMAGE_SNAPSHOT
+    if not urls:
         raise HTTPException(status_code=404, detail=f"No images found in {IMAGE_ROOT}")
-    query_rel = IMAGE_LIST[offset % len(IMAGE_LIST)]
-    start = (offset + 1) % len(IMAGE_LIST)
-    page = IMAGE_LIST[start:start + limit]
-    if len(page) < limit and len(IMAGE_LIST) > 0:
-        page += IMAGE_LIST[0:limit - len(page)]
-    page = [p for p in page if p != query_rel]
-    return {"queryImage": f"/images/{query_rel}", "images": [f"/images/{p}" for p in page]}
+    # ETag is a hash of the page bytes (computed once per cached page), so a
+    # revisited page that hasn't changed costs an empty 304.
+    return cached_json_response(request, *_session_page(urls, version, offset % len(urls), limit))
 
 @app.post("/api/labels/save")
 def save_labels(body: SaveLabelsBody, user=Depends(verify_token)):
     """
     Save labels by:
       1) Ensuring both the query image and all candidate images exist as :Image nodes
-      2) Deleting any previous POSITIVE/NEGATIVE relationships from the query image to others
-      3) Creating new POSITIVE and NEGATIVE relationships (directed from query -> candidate)
+      2) Deleting only the previous POSITIVE/NEGATIVE relationships that are no longer selected
+      3) MERGE-ing the selected POSITIVE and NEGATIVE relationships (directed from query -> candidate);
+         unchanged edges are left in place instead of being deleted and re-created
 
     NOTE: All nodes are labeled :Image. No :Query label is used.
     """
@@ -175,42 +868,32 @@ def save_labels(body: SaveLabelsBody, user=Depends(verify_token)):
     positives = list(dict.fromkeys(body.positives or []))  # de-dupe, keep order
     negatives = list(dict.fromkeys(body.negatives or []))
 
-    # Ensure the query and candidate nodes exist
-    run_query("MERGE (:Image {path:$q})", {"q": q})
-    if positives:
-        run_query("""
-            UNWIND $paths AS p
-            MERGE (:Image {path: p})
-        """, {"paths": positives})
-    if negatives:
-        run_query("""
-            UNWIND $paths AS p
-            MERGE (:Image {path: p})
-        """, {"paths": negatives})
-
-    # Remove old edges from the query image
-    run_query("""
-        MATCH (q:Image {path:$q})-[r:POSITIVE|NEGATIVE]->(:Image)
-        DELETE r
-    """, {"q": q})
-
-    # Add new POSITIVE edges
-    if positives:
-        run_query("""
-            MATCH (q:Image {path:$q})
-            UNWIND $paths AS p
-            MATCH (i:Image {path:p})
+    # One statement, one managed write transaction, one round-trip.
+    # Unit CALL subqueries keep the single q row alive when $pos/$neg are empty.
+    run_in_transaction([("""
+        MERGE (q:Image {path:$q})
+        WITH q
+        CALL {
+            WITH q
+            MATCH (q)-[r:POSITIVE|NEGATIVE]->(i)
+            WHERE (type(r) = 'POSITIVE' AND NOT i.path IN $pos)
+               OR (type(r) = 'NEGATIVE' AND NOT i.path IN $neg)
+            DELETE r
+        }
+        CALL {
+            WITH q
+            UNWIND $pos AS p
+            MERGE (i:Image {path: p})
             MERGE (q)-[:POSITIVE]->(i)
-        """, {"q": q, "paths": positives})
-
-    # Add new NEGATIVE edges
-    if negatives:
-        run_query("""
-            MATCH (q:Image {path:$q})
-            UNWIND $paths AS p
-            MATCH (i:Image {path:p})
-            MERGE (q)-[:NEGATIVE]->(i)
-        """, {"q": q, "paths": negatives})
+        }
+        CALL {
+            WITH q
+            UNWIND $neg AS n
+            MERGE (j:Image {path: n})
+            MERGE (q)-[:NEGATIVE]->(j)
+        }
+    """, {"q": q, "pos": positives, "neg": negatives})])
+    invalidate_stats_cache()
 
     return {"ok": True, "saved": True}
 
@@ -221,31 +904,74 @@ def get_labels(queryImage: str, user=Depends(verify_token)):
       (query:Image)-[:POSITIVE]->(i:Image)
       (query:Image)-[:NEGATIVE]->(i:Image)
     """
-    res_pos = run_query("""
-        MATCH (q:Image {path:$q})-[:POSITIVE]->(i:Image)
-        RETURN i.path as path
-    """, {"q": queryImage})
-    res_neg = run_query("""
-        MATCH (q:Image {path:$q})-[:NEGATIVE]->(i:Image)
-        RETURN i.path as path
-    """, {"q": queryImage})
+    positives, negatives = read_labels(queryImage)
     return {
         "queryImage": queryImage,
-        "positives": [r["path"] for r in res_pos],
-        "negatives": [r["path"] for r in res_neg]
+        "positives": positives,
+        "negatives": negatives
     }
 
-@app.get("/api/batch/{index}", response_model=SessionResponse)
-def get_batch(index: int = PathParam(..., ge=0), user=Depends(verify_token)):
-    if index >= len(BATCHES):
+@app.get("/api/batch/{index}", responses={200: {"model": SessionResponse}})
+def get_batch(request: Request, index: int = PathParam(..., ge=0), user=Depends(verify_token)):
+    responses = BATCH_RESPONSES
+    if index >= len(responses):
         raise HTTPException(status_code=404, detail="Batch index out of range")
-    return BATCHES[index]
+    return cached_json_response(request, *responses[index])
+
+@app.post("/api/batches/compact")
+def compact_batch_log(user=Depends(verify_token)):
+    """
+    Fold the batch log into batches.py. Appends never rewrite batches.py,
+    so this is the on-demand (O(total batches)) step.
+    """
+    with _batches_lock:
+        compact_batches()
+    return {"ok": True, "total_batches": len(BATCHES)}
 
 @app.get("/api/batches/count")
-def get_batches_count(user=Depends(verify_token)):
-    return {"total": len(BATCHES)}
+def get_batches_count(request: Request, user=Depends(verify_token)):
+    return cached_json_response(request, *BATCH_COUNT_RESPONSE)
 
 # ---------------- Stats ----------------
+# Both stats endpoints return orjson bytes directly: the payloads can hold
+# thousands of entries, and a returned Response skips FastAPI's
+# response_model validation + jsonable_encoder walk (the models stay for docs).
+#
+# In-process TTL cache for the stats endpoints. Anything that adds/removes
+# edges, nodes or pending images calls invalidate_stats_cache(); the
+# generation check stops a computation that raced an invalidation from
+# storing its (stale) result.
+# The cache (like IMAGE_SNAPSHOT and the /api/session page cache) is per
+# process. Under several uvicorn workers an invalidation only reaches the
+# worker that made the write; the others can serve stats up to
+# STATS_CACHE_TTL old. Shared state (labels, pending flags) lives in Neo4j.
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+STATS_CACHE_MAX = 1024
+_stats_cache: Dict[tuple, tuple] = {}  # key -> (monotonic ts, orjson body)
+_stats_cache_gen = 0
+_stats_cache_lock = threading.Lock()
+
+def _stats_cache_get(key: tuple):
+    with _stats_cache_lock:
+        hit = _stats_cache.get(key)
+        if hit is not None and time.monotonic() - hit[0] < STATS_CACHE_TTL:
+            return hit[1]
+        return None
+
+def _stats_cache_put(key: tuple, gen: int, value):
+    with _stats_cache_lock:
+        if gen != _stats_cache_gen:
+            return
+        if len(_stats_cache) >= STATS_CACHE_MAX:
+            _stats_cache.clear()
+        _stats_cache[key] = (time.monotonic(), value)
+
+def invalidate_stats_cache():
+    global _stats_cache_gen
+    with _stats_cache_lock:
+        _stats_cache_gen += 1
+        _stats_cache.clear()
+
 @app.post("/api/image_stats/bulk", response_model=StatsBulkResponse)
 def image_stats_bulk(req: StatsBulkRequest, user=Depends(verify_token)):
     """
@@ -253,43 +979,86 @@ def image_stats_bulk(req: StatsBulkRequest, user=Depends(verify_token)):
       positive_count = number of POSITIVE edges connected to the node
       negative_count = number of NEGATIVE edges connected to the node
     """
-    stats_map = {img: {"positive_count": 0, "negative_count": 0} for img in (req.images or [])}
-    if not req.images:
-        return {"stats": stats_map}
-
-    # One query to count POSITIVE connections
-    rows_pos = run_query("""
-        UNWIND $targets AS t
-        MATCH (i:Image {path:t})-[r:POSITIVE]-()
-        RETURN t AS path, count(r) AS c
-    """, {"targets": req.images})
-    for r in rows_pos:
-        stats_map[r["path"]]["positive_count"] = r["c"]
-
-    # One query to count NEGATIVE connections
-    rows_neg = run_query("""
+    images = list(dict.fromkeys(req.images or []))  # de-dupe before hitting Neo4j
+    if not images:
+        return {"stats": {}}
+
+    key = ("bulk", *images)
+    cached = _stats_cache_get(key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+    gen = _stats_cache_gen
+
+    # One node lookup per image serves both counts (single round-trip).
+    # Single-hop COUNT {} subqueries are planned as GetDegree, i.e. read from
+    # the node's per-type degree counters instead of expanding every edge.
+    rows = run_read("""
         UNWIND $targets AS t
-        MATCH (i:Image {path:t})-[r:NEGATIVE]-()
-        RETURN t AS path, count(r) AS c
-    """, {"targets": req.images})
-    for r in rows_neg:
-        stats_map[r["path"]]["negative_count"] = r["c"]
+        MATCH (i:Image {path:t})
+        RETURN t AS path,
+               COUNT { (i)-[:POSITIVE]-() } AS pos,
+               COUNT { (i)-[:NEGATIVE]-() } AS neg
+    """, {"targets": images})
+    # Fill two flat count arrays by request position, then build the
+    # per-image dicts exactly once (no zero-dicts that get replaced).
+    index = {p: i for i, p in enumerate(images)}
+    pos = [0] * len(images)
+    neg = [0] * len(images)
+    for r in rows:
+        i = index[r["path"]]
+        pos[i] = r["pos"]
+        neg[i] = r["neg"]
+    stats_map = {p: {"positive_count": pos[i], "negative_count": neg[i]} for i, p in enumerate(images)}
 
-    return {"stats": stats_map}
+    body = orjson.dumps({"stats": stats_map})
+    _stats_cache_put(key, gen, body)
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/api/stats/summary", response_model=ProjectStatsResponse)
 def get_project_stats(user=Depends(verify_token)):
+    """
+    Cached wrapper around compute_project_stats (see STATS_CACHE_TTL).
+    """
+    cached = _stats_cache_get(("summary",))
+    if cached is None:
+        gen = _stats_cache_gen
+        cached = orjson.dumps(compute_project_stats())
+        _stats_cache_put(("summary",), gen, cached)
+    return Response(content=cached, media_type="application/json")
+
+def compute_project_stats():
     """
     Summaries to match prior app behavior + include CONNECTED relationships + 
     per-image positive/negative stats sorted by a custom key.
     """
     image_count = len(IMAGE_LIST) or 1
 
+    # All reads share one session/transaction, so the global sums and
+    # the per-image rows come from the same snapshot.
+    res_pos, res_neg, res_con, res_pending, rows = run_reads([
+        # Unlabeled single-type patterns are answered from the counts store
+        # (RelationshipCountFromCountStore, O(1)) instead of scanning edges;
+        # every node is an :Image, so the labels added nothing but the scan.
+        # The undirected CONNECTED count matched each edge from both ends.
+        ("MATCH ()-[:POSITIVE]->() RETURN count(*) as c", None),
+        ("MATCH ()-[:NEGATIVE]->() RETURN count(*) as c", None),
+        ("MATCH ()-[:CONNECTED]->() RETURN count(*) * 2 as c", None),
+        (Q_PENDING_COUNT, None),
+        # Per-image degrees (GetDegree) and the sort_key ordering are done
+        # server-side; rows arrive ready to serialize.
+        ("""
+        MATCH (i:Image)
+        WITH i.path AS path,
+             COUNT { (i)-[:POSITIVE]-() } AS pos,
+             COUNT { (i)-[:NEGATIVE]-() } AS neg
+        WITH path, pos, neg, (CASE WHEN pos < neg THEN pos ELSE neg END) + pos + neg + pos AS sort_key
+        RETURN path, pos, neg, sort_key
+        ORDER BY sort_key
+        """, None),
+    ])
+
     # --- Global aggregates ---
-    res_pos = run_query("MATCH (:Image)-[:POSITIVE]->(:Image) RETURN count(*) as c")
-    res_neg = run_query("MATCH (:Image)-[:NEGATIVE]->(:Image) RETURN count(*) as c")
-    res_con = run_query("MATCH (:Image)-[:CONNECTED]-(:Image) RETURN count(*) as c")
 
     sum_pos = res_pos[0]["c"] if res_pos else 0
     sum_neg = res_neg[0]["c"] if res_neg else 0
@@ -303,33 +1072,14 @@ def get_project_stats(user=Depends(verify_token)):
     mean_neg = total_neg_matches / image_count
     mean_con = total_con_matches / image_count
 
-    global PENDING_NON_LABELED
-    pending_count = len(PENDING_NON_LABELED)
+    pending = res_pending[0]["c"] if res_pending else 0
 
     # --- Per-image stats ---
-    rows = run_query("""
-        MATCH (i:Image)
-        OPTIONAL MATCH (i)-[p:POSITIVE]-()
-        WITH i, count(p) AS pos
-        OPTIONAL MATCH (i)-[n:NEGATIVE]-()
-        RETURN i.path AS path, pos, count(n) AS neg
-    """)
-
-    image_stats = []
-    for r in rows:
-        pos = r.get("pos", 0)
-        neg = r.get("neg", 0)
-        path = r.get("path")
-        sort_key = min(pos, neg) + (pos + neg) + pos
-        image_stats.append({
-            "path": path,
-            "positive_count": pos,
-            "negative_count": neg,
-            "sort_key": sort_key
-        })
-
-    # sort ascending
-    image_stats.sort(key=lambda x: x["sort_key"])
+    # already sorted ascending by sort_key = min(pos, neg) + (pos + neg) + pos
+    image_stats = [
+        {"path": r["path"], "positive_count": r["pos"], "negative_count": r["neg"], "sort_key": r["sort_key"]}
+        for r in rows
+    ]
 
     return {
         "image_count": image_count,
@@ -341,7 +1091,7 @@ def get_project_stats(user=Depends(verify_token)):
         "sum_negative_count": sum_neg,
         "total_connected_matches": total_con_matches,
         "mean_connected_matches_per_image": mean_con,
-        "pending_non_labeled_count": pending_count,
+        "pending_non_labeled_count": pending,
         "image_stats_sorted": image_stats,   # ✅ added field
     }
 
@@ -349,21 +1099,70 @@ def get_project_stats(user=Depends(verify_token)):
 # ######################
 
 
+IMG_NUM_RE = re.compile(r"img_(\d+)")
+# Extensions (both cases) whose img_### files claim that number.
+_IMG_NUM_TAKEN_EXTS = frozenset(IMAGE_EXTS | {e.upper() for e in IMAGE_EXTS})
+
 def get_next_image_index(root: Path) -> int:
     """
     Scan IMAGE_ROOT for files named img_### and return next available number.
     """
     max_num = 0
     for n in os.listdir(root):
-        m = re.match(r"img_(\d+)", Path(n).stem)
+        # \d+ stops at the extension dot, so matching the raw name gives the
+        # same number as Path(n).stem without building a Path per entry.
+        m = IMG_NUM_RE.match(n)
         if m:
             max_num = max(max_num, int(m.group(1)))
     return max_num + 1
 
 
-def safe_extract_zip(zip_path: Path, extract_to: Path) -> List[Path]:
+# Next img_### number to hand out: seeded from the startup scan (or one
+# directory scan on first use), then advanced in memory (callers hold
+# _import_lock).
+_next_image_idx: Optional[int] = None
+
+def seed_next_image_index(files) -> None:
+    """
+    Initialise the img_### counter from already-scanned relative paths
+    (top-level entries only), so no upload has to list IMAGE_ROOT.
+    """
+    global _next_image_idx
+    max_num = 0
+    for rel in files:
+        m = IMG_NUM_RE.match(rel)
+        if m and "/" not in rel:
+            max_num = max(max_num, int(m.group(1)))
+    with _import_lock:
+        if _next_image_idx is None:
+            _next_image_idx = max_num + 1
+
+def next_image_path(ext: str) -> Tuple[str, Path]:
+    """
+    Reserve the next free img_### name in IMAGE_ROOT; returns (name, path).
+    """
+    global _next_image_idx
+    if _next_image_idx is None:
+        _next_image_idx = get_next_image_index(Path(IMAGE_ROOT))
+    while True:
+        stem = f"img_{_next_image_idx:03d}"
+        _next_image_idx += 1
+        # The counter doesn't see files copied in by hand. A number counts as
+        # taken whatever its extension, so img_005.png is never issued next
+        # to an existing img_005.jpg.
+        if not any(os.path.exists(os.path.join(IMAGE_ROOT, stem + e))
+                   for e in _IMG_NUM_TAKEN_EXTS | {ext}):
+            return stem + ext, Path(IMAGE_ROOT) / (stem + ext)
+
+
+def safe_extract_zip(zip_path: Path, extract_to: Path,
+                     dest_for: Optional[Callable[[str], Path]] = None,
+                     include: Optional[Callable[[str], bool]] = None) -> List[Path]:
     """
     Extracts a ZIP file safely into extract_to directory, ignoring directories inside.
+    dest_for(filename), if given, picks each member's final path up front so
+    callers that rename don't need a second pass.
+    include(filename), if given, skips members it rejects (never written).
     Returns list of extracted file paths.
     """
     extracted_files = []
@@ -373,15 +1172,67 @@ def safe_extract_zip(zip_path: Path, extract_to: Path) -> List[Path]:
                 continue
             # Sanitize filename
             filename = os.path.basename(member.filename)
-            if not filename:
+            if not filename or (include is not None and not include(filename)):
                 continue
-            dest_path = extract_to / filename
+            dest_path = dest_for(filename) if dest_for else extract_to / filename
+            # Stream member by member in UPLOAD_CHUNK_SIZE pieces (the default
+            # 64 KiB buffer means many more read/write calls per image).
             with zip_ref.open(member) as src, open(dest_path, 'wb') as out_f:
-                shutil.copyfileobj(src, out_f)
+                shutil.copyfileobj(src, out_f, UPLOAD_CHUNK_SIZE)
             extracted_files.append(dest_path)
     return extracted_files
 
 
+# Serializes extract+rename so two concurrent uploads can't claim the same
+# img_### index (they used to be serialized by running on the event loop).
+_import_lock = threading.Lock()
+
+
+def _is_zip_image(filename: str) -> bool:
+    # "._name.jpg" are macOS AppleDouble resource forks (under __MACOSX/),
+    # not images, even though the extension matches.
+    return is_image_name(filename) and not filename.startswith("._")
+
+
+def import_zip_images(zip_path: Path) -> List[str]:
+    """
+    Extract a ZIP into IMAGE_ROOT with its images named img_### after the
+    highest existing index. Returns the new web paths ("/images/img_###.ext").
+    """
+    with _import_lock:
+        # Members are written straight to their img_### names (no rename pass,
+        # and nothing already in IMAGE_ROOT is overwritten by a ZIP entry name).
+        # Only image members: .DS_Store, Thumbs.db, notes etc. would otherwise
+        # be renamed img_### and listed, MERGEd and served as images.
+        extracted = safe_extract_zip(zip_path, Path(IMAGE_ROOT),
+                                     dest_for=lambda fn: next_image_path(Path(fn).suffix.lower())[1],
+                                     include=_is_zip_image)
+        if not extracted:
+            raise HTTPException(status_code=400, detail="No images found in zip")
+        return [f"/images/{p.name}" for p in extracted]
+
+
+async def save_upload(file: UploadFile, dest_dir: Path) -> Path:
+    """
+    Copy an uploaded file into dest_dir in UPLOAD_CHUNK_SIZE pieces, so memory
+    use stays constant regardless of the ZIP size. The whole copy runs in one
+    worker thread, keeping the blocking disk I/O off the event loop.
+    Only the basename of the client filename is used, so names like
+    "../../x.zip" can't write outside dest_dir. Returns the saved path.
+    """
+    dest = dest_dir / (Path(file.filename or "").name or "upload.zip")
+
+    def copy():
+        file.file.seek(0)
+        with open(dest, "wb") as f:
+            shutil.copyfileobj(file.file, f, UPLOAD_CHUNK_SIZE)
+
+    await run_in_threadpool(copy)
+    return dest
+
+
+PAIR_BATCH_SIZE = 10000  # image pairs per write transaction
+
 def connect_all_images_in_graph(image_paths: List[str]):
     """
     Given a list of image paths (like /images/img_888.jpg),
@@ -391,22 +1242,30 @@ def connect_all_images_in_graph(image_paths: List[str]):
     if not image_paths or len(image_paths) < 2:
         return
 
-    # Merge nodes first
-    run_query("""
-        UNWIND $paths AS p
-        MERGE (:Image {path: p})
-    """, {"paths": image_paths})
+    # Connect all pairs (undirected, only once). The pairs are built here so
+    # Cypher sees exactly N*(N-1)/2 rows instead of an N*N cross product it
+    # has to filter, and are written in bounded transactions.
+    paths = sorted(set(image_paths))
+    pairs = [{"a": a, "b": b} for i, a in enumerate(paths) for b in paths[i + 1:]]
 
-    # Connect all pairs (undirected, only once)
-    run_query("""
-        UNWIND $paths AS p1
-        UNWIND $paths AS p2
-        WITH p1, p2
-        WHERE p1 < p2
-        MATCH (a:Image {path:p1}), (b:Image {path:p2})
-        MERGE (a)-[:POSITIVE]-(b)
-    """, {"paths": image_paths})
+    def merge_nodes(tx):
+        tx.run("""
+            UNWIND $paths AS p
+            MERGE (:Image {path: p})
+        """, {"paths": paths}).consume()
+
+    def merge_pairs(tx, chunk):
+        tx.run("""
+            UNWIND $pairs AS pr
+            MATCH (a:Image {path:pr.a}), (b:Image {path:pr.b})
+            MERGE (a)-[:POSITIVE]-(b)
+        """, {"pairs": chunk}).consume()
 
+    # One session for the node MERGE and every pair chunk.
+    with driver.session(database=NEO4J_DB) as session:
+        session.execute_write(merge_nodes)
+        for start in range(0, len(pairs), PAIR_BATCH_SIZE):
+            session.execute_write(merge_pairs, pairs[start:start + PAIR_BATCH_SIZE])
 
 
 @app.post("/api/upload_batch")
@@ -418,35 +1277,19 @@ async def upload_batch(file: UploadFile = File(...), user=Depends(verify_token))
       3. Rename extracted files as img_### starting after highest index
       4. Create :Image nodes and fully connect them in Neo4j
     """
-    dest_zip = BATCH_DIR / file.filename
-    contents = await file.read()
-    with open(dest_zip, "wb") as f:
-        f.write(contents)
+    dest_zip = await save_upload(file, BATCH_DIR)
 
     try:
-        # Step 1: Extract safely
-        extracted = safe_extract_zip(dest_zip, Path(IMAGE_ROOT))
-        if not extracted:
-            raise HTTPException(status_code=400, detail="No images found in zip")
-
-        # Step 2: Find next number in existing images
-        next_idx = get_next_image_index(Path(IMAGE_ROOT))
-
-        renamed_paths = []
-        for old_path in extracted:
-            ext = old_path.suffix.lower()
-            new_name = f"img_{next_idx:03d}{ext}"
-            new_path = Path(IMAGE_ROOT) / new_name
-            os.rename(old_path, new_path)
-            renamed_paths.append(f"/images/{new_name}")
-            next_idx += 1
+        # Steps 1-2: extract to img_### names (disk-bound -> off the event loop)
+        renamed_paths = await run_in_threadpool(import_zip_images, dest_zip)
 
         # Step 3: Merge as :Image nodes and connect all
-        connect_all_images_in_graph(renamed_paths)
+        # (blocking Neo4j driver -> run off the event loop)
+        await run_in_threadpool(connect_all_images_in_graph, renamed_paths)
+        invalidate_stats_cache()
 
-        # Step 4: Refresh global image list (so UI gets updated)
-        global IMAGE_LIST
-        IMAGE_LIST = scan_images(IMAGE_ROOT)
+        # Step 4: Add the new files to the global image list (so UI gets updated)
+        await run_in_threadpool(add_images, [p[len("/images/"):] for p in renamed_paths])
 
         return {
             "ok": True,
@@ -468,43 +1311,26 @@ async def upload_non_labeled(file: UploadFile = File(...), user=Depends(verify_t
       2. Unzip into /images/
       3. Rename sequentially (img_###)
       4. Do not connect in Neo4j yet
-      5. Keep list of new image paths in memory (PENDING_NON_LABELED)
+      5. Flag the new :Image nodes as pending (see mark_pending)
     """
-    dest_zip = NON_LABELED_DIR / file.filename
-    contents = await file.read()
-    with open(dest_zip, "wb") as f:
-        f.write(contents)
+    dest_zip = await save_upload(file, NON_LABELED_DIR)
 
     try:
-        # Step 1: Extract safely
-        extracted = safe_extract_zip(dest_zip, Path(IMAGE_ROOT))
-        if not extracted:
-            raise HTTPException(status_code=400, detail="No images found in zip")
+        # Steps 1-2: extract to img_### names (disk-bound -> off the event loop)
+        renamed_paths = await run_in_threadpool(import_zip_images, dest_zip)
+
+        # Step 3: Flag as pending for later processing
+        await run_in_threadpool(mark_pending, renamed_paths)
+        invalidate_stats_cache()
 
-        # Step 2: Find next number in existing images
-        next_idx = get_next_image_index(Path(IMAGE_ROOT))
-
-        renamed_paths = []
-        for old_path in extracted:
-            ext = old_path.suffix.lower()
-            new_name = f"img_{next_idx:03d}{ext}"
-            new_path = Path(IMAGE_ROOT) / new_name
-            os.rename(old_path, new_path)
-            renamed_paths.append(f"/images/{new_name}")
-            next_idx += 1
-
-        # Step 3: Save pending list for later processing
-        global PENDING_NON_LABELED
-        PENDING_NON_LABELED.extend(renamed_paths)
-
-        # Step 4: Refresh global IMAGE_LIST (for /api/session)
-        global IMAGE_LIST
-        IMAGE_LIST = scan_images(IMAGE_ROOT)
-        print(len(PENDING_NON_LABELED))
+        # Step 4: Add the new files to IMAGE_LIST (for /api/session)
+        await run_in_threadpool(add_images, [p[len("/images/"):] for p in renamed_paths])
+        pending = await run_in_threadpool(pending_count)
+        print(f"[UPLOAD] {len(renamed_paths)} non-labeled images imported; {pending} pending")
         return {
             "ok": True,
             "imported": len(renamed_paths),
-            "pending_to_process": len(PENDING_NON_LABELED),
+            "pending_to_process": pending,
             "new_images": renamed_paths
         }
 
@@ -515,84 +1341,57 @@ async def upload_non_labeled(file: UploadFile = File(...), user=Depends(verify_t
 
 @app.post("/api/process_pending")
 def process_pending(user=Depends(verify_token)):
-    import json, importlib, time, traceback
-    from pathlib import Path
     import retrieval  # ✅ use retrieval instead of random
 
     print("\n[PROCESS_PENDING] Starting pending processing...")
     start_time = time.time()
 
-    global PENDING_NON_LABELED, BATCHES, IMAGE_LIST
-
     try:
-        project_root = Path(__file__).resolve().parent
-        BATCH_FILE = project_root / "batches.py"
         print(f"[PROCESS_PENDING] Using batch file: {BATCH_FILE}")
+        # --- Step 1: Pending :Image nodes (merged + flagged at upload) ---
+        pending = pending_images()
+        print(f"[PROCESS_PENDING] Pending count: {len(pending)}")
 
-        if not BATCH_FILE.exists():
-            raise HTTPException(status_code=500, detail=f"batches.py not found at {BATCH_FILE}")
-
-        print(f"[PROCESS_PENDING] Pending count: {len(PENDING_NON_LABELED)}")
-
-        import batches as batches_module
-        importlib.invalidate_caches()
-        importlib.reload(batches_module)
-
-        if not PENDING_NON_LABELED:
+        if not pending:
             print("[PROCESS_PENDING] No pending images. Exiting early.")
             return {"ok": True, "message": "No pending images"}
 
-        # --- Step 1: Merge in Neo4j ---
-        print("[PROCESS_PENDING] Merging nodes in Neo4j...")
-        merge_all_images_as_nodes([p.replace("/images/", "") for p in PENDING_NON_LABELED])
-
-        # --- Step 2: Refresh available images ---
-        IMAGE_LIST = scan_images(IMAGE_ROOT)
-        all_web_paths = [f"/images/{rel}" for rel in IMAGE_LIST]
+        # --- Step 2: Refresh available images (MERGE any the scan finds new) ---
+        sync_image_nodes(rescan_images())
+        all_web_paths = list(IMAGE_LIST_URLS)
         print(f"[PROCESS_PENDING] Total available images: {len(all_web_paths)}")
 
-        # --- Step 3: Retrieval ---
+        # --- Step 3: Retrieval (all pending queries in one batched call) ---
         K = 4
-        new_entries = []
-        for idx, web_q in enumerate(PENDING_NON_LABELED, 1):
-            print(f"[PROCESS_PENDING] [{idx}/{len(PENDING_NON_LABELED)}] Retrieving for {web_q}...")
-            try:
-                retrieved = retrieval.top_k_similar(web_q, all_web_paths, k=K)
-                candidates = [r["path"] for r in retrieved]
-                print(f"  ↳ got {len(candidates)} candidates")
-            except Exception as e:
-                print(f"[WARN] retrieval failed for {web_q}: {e}")
-                traceback.print_exc()
-                candidates = [p for p in all_web_paths if p != web_q][:K]
-
-            new_entries.append({"queryImage": web_q, "images": candidates})
-
-        # --- Step 4: Write to batches.py ---
-        print(f"[PROCESS_PENDING] Writing {len(new_entries)} entries to batches.py")
-        existing = list(getattr(batches_module, "BATCHES", []))
-        index_by_query = {e["queryImage"]: i for i, e in enumerate(existing) if isinstance(e, dict)}
-        added = 0
-        for entry in new_entries:
-            q = entry["queryImage"]
-            if q in index_by_query:
-                existing[index_by_query[q]] = entry
-            else:
-                existing.append(entry)
-                added += 1
-
-        with open(BATCH_FILE, "w", encoding="utf-8") as f:
-            f.write("BATCHES = ")
-            json.dump(existing, f, indent=2)
-            f.write("\n")
-
-        # --- Step 5: Reload batches ---
-        importlib.invalidate_caches()
-        importlib.reload(batches_module)
-        BATCHES = batches_module.BATCHES
-        print(f"[PROCESS_PENDING] Reloaded batches: {len(BATCHES)} total")
-
-        processed = len(PENDING_NON_LABELED)
-        PENDING_NON_LABELED.clear()
+        print(f"[PROCESS_PENDING] Retrieving for {len(pending)} images...")
+        try:
+            results = [[r["path"] for r in retrieved]
+                       for retrieved in retrieval.top_k_similar_batch(pending, all_web_paths, k=K)]
+        except Exception as e:
+            print(f"[WARN] retrieval failed: {e}")
+            traceback.print_exc()
+            results = [[p for p in all_web_paths if p != web_q][:K] for web_q in pending]
+        new_entries = [{"queryImage": q, "images": c} for q, c in zip(pending, results)]
+
+        # --- Step 4: Append to the batch log + publish (no module reload) ---
+        print(f"[PROCESS_PENDING] Writing {len(new_entries)} entries to {BATCH_LOG_FILE.name}")
+        with _batches_lock:
+            # A query that already has a batch gets it replaced in place.
+            updates = []
+            added = 0
+            for entry in new_entries:
+                i = BATCH_INDEX.get(entry["queryImage"])
+                if i is None:
+                    i = len(BATCHES) + added
+                    added += 1
+                updates.append((i, entry))
+            save_batches(updates)
+        print(f"[PROCESS_PENDING] Saved batches: {len(BATCHES)} total")
+
+        # Only the images handled here; uploads that landed meanwhile stay pending
+        clear_pending(pending)
+        processed = len(pending)
+        invalidate_stats_cache()
         took = round(time.time() - start_time, 2)
         print(f"[PROCESS_PENDING] Done! processed={processed}, added={added}, took={took}s")
 
@@ -601,7 +1400,7 @@ def process_pending(user=Depends(verify_token)):
             "processed": processed,
             "batches_added": added,
             "total_batches": len(BATCHES),
-            "batches_file": str(BATCH_FILE),
+            "batches_file": str(BATCH_LOG_FILE),
             "took_seconds": took,
         }
 
@@ -616,11 +1415,9 @@ def get_batch_index_by_query(body: dict, user=Depends(verify_token)):
     Given a query image path (e.g. '/images/img_012.jpg'):
       1. If it exists in BATCHES, return its index.
       2. Otherwise, generate a new batch dynamically using retrieval.
-      3. If generated, save it into batches.py and return the new index.
+      3. If generated, append it to the batch log and return the new index.
       4. Also include any existing POSITIVE/NEGATIVE labels for that query.
     """
-    import importlib, json, traceback
-    from pathlib import Path
     import retrieval
 
     query_path = body.get("queryImage")
@@ -628,30 +1425,25 @@ def get_batch_index_by_query(body: dict, user=Depends(verify_token)):
         raise HTTPException(status_code=400, detail="Missing queryImage")
 
     # ✅ Step 1: Check if already exists in batches
-    for idx, entry in enumerate(BATCHES):
-        if isinstance(entry, dict) and entry.get("queryImage") == query_path:
-            # Get existing relationships
-            pos = [r["path"] for r in run_query("""
-                MATCH (:Image {path:$q})-[:POSITIVE]->(i:Image) RETURN i.path as path
-            """, {"q": query_path})]
-            neg = [r["path"] for r in run_query("""
-                MATCH (:Image {path:$q})-[:NEGATIVE]->(i:Image) RETURN i.path as path
-            """, {"q": query_path})]
-
-            return {
-                "ok": True,
-                "index": idx,
-                "queryImage": query_path,
-                "positives": pos,
-                "negatives": neg,
-                "new_batch_created": False
-            }
+    idx = BATCH_INDEX.get(query_path)
+    if idx is not None:
+        # Get existing relationships
+        pos, neg = read_labels(query_path)
+
+        return {
+            "ok": True,
+            "index": idx,
+            "queryImage": query_path,
+            "positives": pos,
+            "negatives": neg,
+            "new_batch_created": False
+        }
 
     # ✅ Step 2: If not found, dynamically create a new batch
     print(f"[DYNAMIC_BATCH] Query image not in batches, creating new batch for {query_path}")
     try:
-        all_images = scan_images(IMAGE_ROOT)
-        all_web_paths = [f"/images/{rel}" for rel in all_images]
+        # IMAGE_LIST is kept current by uploads, the watcher and /api/refresh
+        all_web_paths = list(IMAGE_LIST_URLS)
 
         # Run retrieval for top K similar images
         K = 4
@@ -660,38 +1452,20 @@ def get_batch_index_by_query(body: dict, user=Depends(verify_token)):
 
         # Ensure nodes exist
         merge_all_images_as_nodes([query_path] + candidates)
+        invalidate_stats_cache()
 
         # ✅ Step 3: Check for existing label edges
-        pos_edges = [r["path"] for r in run_query("""
-            MATCH (:Image {path:$q})-[:POSITIVE]->(i:Image) RETURN i.path as path
-        """, {"q": query_path})]
-        neg_edges = [r["path"] for r in run_query("""
-            MATCH (:Image {path:$q})-[:NEGATIVE]->(i:Image) RETURN i.path as path
-        """, {"q": query_path})]
-
-        # ✅ Step 4: Append to batches.py and memory
+        pos_edges, neg_edges = read_labels(query_path)
+
+        # ✅ Step 4: Append to the batch log and memory
         new_entry = {
             "queryImage": query_path,
             "images": candidates
         }
 
-        project_root = Path(__file__).resolve().parent
-        BATCH_FILE = project_root / "batches.py"
-
-        existing = list(getattr(importlib.import_module("batches"), "BATCHES", []))
-        existing.append(new_entry)
-
-        with open(BATCH_FILE, "w", encoding="utf-8") as f:
-            f.write("BATCHES = ")
-            json.dump(existing, f, indent=2)
-            f.write("\n")
-
-        importlib.invalidate_caches()
-        import batches as batches_module
-        importlib.reload(batches_module)
-        globals()["BATCHES"] = batches_module.BATCHES
-
-        new_index = len(BATCHES) - 1
+        with _batches_lock:
+            new_index = len(BATCHES)
+            save_batches([(new_index, new_entry)])
         print(f"[DYNAMIC_BATCH] Added new batch #{new_index} for {query_path}")
 
         return {
@@ -1,22 +1,38 @@
 import os
-import json
+import fcntl
+import orjson
 import glob
+import functools
+import itertools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import numpy as np
 from PIL import Image
-from typing import List, Dict
+from typing import List, Dict, Optional
 from tqdm import tqdm
 from pathlib import Path
 import open_clip
-from sklearn.metrics.pairwise import cosine_similarity
+from torch.utils.data import BatchSampler, DataLoader, Dataset
+from torchvision.io import ImageReadMode, decode_image, decode_jpeg, read_file
+from torchvision.transforms import v2 as T
 from safetensors.torch import load_file as safe_load_file
 
+try:
+    import faiss  # optional: fused inner-product top-k search
+except ImportError:
+    faiss = None
+
 # ============================================================
 # ENVIRONMENT SETUP (OFFLINE)
 # ============================================================
 os.environ["HF_HOME"] = "/root/.cache/huggingface"
 os.environ["OPENCLIP_CACHE_DIR"] = "/root/.cache/huggingface"
 os.environ["TORCH_HOME"] = "/root/.cache/torch"
+# Read when the CUDA caching allocator starts (first allocation, below):
+# growable segments stop query-sized allocations from fragmenting the pool.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
 os.environ["HF_HUB_OFFLINE"] = "1"
 
 # ============================================================
@@ -48,130 +64,523 @@ try:
     state_dict = safe_load_file(MODEL_PATH)
     model.load_state_dict(state_dict, strict=False)
     model = model.to(DEVICE).eval()
-    _, _, preprocess = open_clip.create_model_and_transforms(MODEL_NAME)
+    # Preprocess constants from the model itself; create_model_and_transforms
+    # would construct (and discard) a second copy of the model for these.
+    IMAGE_MEAN = getattr(model.visual, "image_mean", None) or open_clip.OPENAI_DATASET_MEAN
+    IMAGE_STD = getattr(model.visual, "image_std", None) or open_clip.OPENAI_DATASET_STD
     EMBED_DIM = int(getattr(getattr(model, "visual", model), "output_dim", 512))
     print(f"[retrieval] ✅ Model loaded successfully (offline safetensors). EMBED_DIM={EMBED_DIM}")
 except Exception as e:
     raise RuntimeError(f"[retrieval] ❌ Failed to load safetensors model from {MODEL_PATH}: {e}")
 
+# CLIP eval preprocessing as tensor ops (the steps of open_clip's PIL
+# transform): decode to uint8 with torchvision (libjpeg-turbo/libpng), then
+# resize + center-crop per image and convert/normalize per batch. On CUDA
+# this runs on the device, so only uint8 pixels cross the bus; JPEGs cross
+# still compressed and are decoded by nvJPEG.
+GPU_PREPROCESS = DEVICE == "cuda"
+# Side stream for that work: batch N+1 is decoded/preprocessed there while
+# batch N is encoded on the default stream.
+_prep_stream = torch.cuda.Stream() if GPU_PREPROCESS else None
+_image_size = getattr(model.visual, "image_size", 224)
+_image_size = _image_size[0] if isinstance(_image_size, (tuple, list)) else _image_size
+resize_crop = T.Compose([
+    T.Resize(_image_size, interpolation=T.InterpolationMode.BICUBIC, antialias=True),
+    T.CenterCrop(_image_size),
+])
+# Normalize constants, built once on the device and scaled to 0..255 so the
+# uint8 batch is converted and normalized in a single sub/div.
+_PIXEL_MEAN = torch.tensor(IMAGE_MEAN, device=DEVICE).view(1, 3, 1, 1) * 255
+_PIXEL_STD = torch.tensor(IMAGE_STD, device=DEVICE).view(1, 3, 1, 1) * 255
+
+# Images per encode_image call and CPU workers decoding/preprocessing them.
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", str(min(8, os.cpu_count() or 1))))
+# Decode threads per worker; libjpeg/libpng release the GIL while decoding.
+DECODE_THREADS = int(os.getenv("DECODE_THREADS", "4"))
+
+# torch.compile the visual tower on CUDA (fused kernels). Default mode, not
+# "reduce-overhead": CUDA graphs keep thread-local state, while encodes run
+# on whichever threadpool thread serves the request. Compilation is lazy;
+# warmup() (called from main's lifespan) pays it at startup.
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "1") == "1" and DEVICE == "cuda"
+_eager_visual = model.visual
+if TORCH_COMPILE:
+    model.visual = torch.compile(_eager_visual)
+# One forward pass at a time: the GPU is shared anyway, and request threads
+# never compile/run the same graph concurrently.
+_encode_lock = threading.Lock()
+
+def _encode(batch: torch.Tensor) -> torch.Tensor:
+    global TORCH_COMPILE
+    with _encode_lock:
+        try:
+            return model.encode_image(batch)
+        except Exception as e:
+            if model.visual is _eager_visual:
+                raise
+            # Compile errors surface on first use; fall back for good.
+            print(f"[retrieval] ⚠️ compiled forward failed ({e}); using eager mode.")
+            model.visual = _eager_visual
+            TORCH_COMPILE = False
+            return model.encode_image(batch)
+
+def warmup():
+    """
+    Run one forward per batch shape the embed path uses (single query, full
+    batch), so compilation and CUDA init happen now, not in a request.
+    """
+    with torch.no_grad(), torch.autocast(device_type="cuda", dtype=torch.float16,
+                                         enabled=DEVICE == "cuda"):
+        for n in sorted({1, EMBED_BATCH_SIZE}):
+            _encode(torch.zeros(n, 3, _image_size, _image_size, device=DEVICE))
+    print(f"[retrieval] ✅ Warmed up (compiled={TORCH_COMPILE}).")
+
 # ============================================================
 # CACHE CONFIGURATION
 # ============================================================
 CACHE_DIR = Path("/data/embeddings")
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
-EMB_FILE = CACHE_DIR / "embeddings.npy"
-PATH_FILE = CACHE_DIR / "paths.json"
+# Append-only layout: each batch of new images is written as one more
+# shard_NNNNNN.npy holding just those rows, and their paths are appended to
+# paths.txt (one path per line, no JSON). manifest.json lists the shards in
+# row order; it is replaced atomically and written last, so it is the commit
+# point. Adding M images costs O(M) I/O instead of rewriting the cache.
+MANIFEST_FILE = CACHE_DIR / "manifest.json"
+PATH_FILE = CACHE_DIR / "paths.txt"
+# flock()ed while the cache files are read or changed: other processes
+# (more workers, a CLI run) may share CACHE_DIR.
+LOCK_FILE = CACHE_DIR / ".lock"
+# Single-file layout used before shards; migrated on first load.
+LEGACY_EMB_FILE = CACHE_DIR / "embeddings.npy"
+LEGACY_PATH_FILE = CACHE_DIR / "paths.json"
+# Once this many shards exist, the next append compacts them into one.
+MAX_SHARDS = 64
+# On-disk/in-memory dtype of the cache. Unit-norm components lose nothing
+# that matters to the ranking in fp16, and it halves the file, the pages
+# mapped in and the bytes gathered per query. Similarity math runs in fp32.
+CACHE_DTYPE = np.float16
 
-_embs: np.ndarray = np.zeros((0, 1), dtype=np.float32)
+_manifest: List[dict] = []  # [{"file", "start", "count"}] in row order
+_shards: List[np.ndarray] = []  # memory-mapped, one per manifest entry
+_shard_starts: np.ndarray = np.zeros(0, dtype=np.int64)  # first global row of each
 _paths: List[str] = []
+_paths_end = 0  # byte offset in paths.txt just past the manifest's last row
+_path_to_idx: Dict[str, int] = {}  # _paths -> global row; replaced, never mutated
+_manifest_stamp = None  # (mtime_ns, size) of the manifest last loaded/written
+# Guards the cache globals (LOCK_FILE guards the files across processes);
+# similarity math runs outside it so concurrent top_k_similar calls only
+# serialize on cache maintenance.
+_cache_lock = threading.Lock()
 
 # ============================================================
 # UTILITY FUNCTIONS
 # ============================================================
+# Bounded: a long-running server sees an open-ended stream of paths.
+@functools.lru_cache(maxsize=65536)
 def _norm_path(p: str) -> str:
     return os.path.abspath(os.path.normpath(p))
 
+@contextmanager
+def _cache_file_lock():
+    """Exclusive flock on LOCK_FILE; not re-entrant, even within a process."""
+    with open(LOCK_FILE, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _stat_manifest():
+    try:
+        st = MANIFEST_FILE.stat()
+        return st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        return None
+
+def _write_manifest(entries: List[dict]):
+    tmp = MANIFEST_FILE.with_suffix(".tmp")
+    tmp.write_bytes(orjson.dumps(entries))
+    os.replace(tmp, MANIFEST_FILE)
+
+def _write_shard(arr: np.ndarray) -> str:
+    """Save a new shard under a fresh name (never overwriting a mapped file)."""
+    seq = max((int(e["file"][len("shard_"):-len(".npy")]) for e in _manifest), default=-1) + 1
+    name = f"shard_{seq:06d}.npy"
+    tmp = CACHE_DIR / f"{name}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp, CACHE_DIR / name)
+    return name
+
+def _set_cache(entries: List[dict], paths: List[str], paths_end: int,
+               path_to_idx: Optional[Dict[str, int]] = None):
+    global _manifest, _shards, _shard_starts, _paths, _paths_end, _path_to_idx, _manifest_stamp
+    _manifest = entries
+    # Memory-mapped: only the rows actually touched are paged in.
+    _shards = [np.load(CACHE_DIR / e["file"], mmap_mode="r") for e in entries]
+    _shard_starts = np.array([e["start"] for e in entries], dtype=np.int64)
+    _paths = paths
+    _paths_end = paths_end
+    _path_to_idx = path_to_idx if path_to_idx is not None else dict(zip(paths, range(len(paths))))
+    _manifest_stamp = _stat_manifest()
+
+def _migrate_legacy_cache():
+    try:
+        paths = [_norm_path(p) for p in orjson.loads(LEGACY_PATH_FILE.read_bytes())]
+        count = len(np.load(LEGACY_EMB_FILE, mmap_mode="r"))
+        if count != len(paths):
+            raise ValueError(f"{count} embeddings for {len(paths)} paths")
+        if any("\n" in p for p in paths):
+            raise ValueError("a cached path contains a newline")
+        tmp = PATH_FILE.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8", errors="surrogateescape") as f:
+            f.writelines(p + "\n" for p in paths)
+        os.replace(tmp, PATH_FILE)
+        os.replace(LEGACY_EMB_FILE, CACHE_DIR / "shard_000000.npy")
+        _write_manifest([{"file": "shard_000000.npy", "start": 0, "count": count}])
+        LEGACY_PATH_FILE.unlink()
+        print(f"[retrieval] Migrated {count} cached embeddings to shards.")
+    except Exception as e:
+        print(f"[retrieval] Failed to migrate legacy cache: {e}")
+
 def _load_cache():
-    global _embs, _paths
-    if EMB_FILE.exists() and PATH_FILE.exists():
+    """(Re)load the shard list, only when manifest.json changed on disk."""
+    stamp = _stat_manifest()
+    if stamp is not None and stamp == _manifest_stamp:
+        return
+    with _cache_file_lock():
+        _reload_cache()
+
+def _reload_cache():
+    # caller holds _cache_file_lock
+    global _manifest_stamp
+    if not MANIFEST_FILE.exists() and LEGACY_EMB_FILE.exists() and LEGACY_PATH_FILE.exists():
+        _migrate_legacy_cache()
+    stamp = _stat_manifest()
+    if stamp is not None and stamp == _manifest_stamp:
+        return
+    if stamp is not None:
         try:
-            arr = np.load(EMB_FILE)
-            with open(PATH_FILE, "r", encoding="utf-8") as f:
-                paths = json.load(f)
-            if arr.ndim == 2 and len(paths) == arr.shape[0]:
-                _embs = arr.astype("float32", copy=False)
-                _paths = [_norm_path(p) for p in paths]
-                print(f"[retrieval] Loaded {_embs.shape[0]} embeddings from cache.")
-                return
+            entries = orjson.loads(MANIFEST_FILE.read_bytes())
+            total = sum(e["count"] for e in entries)
+            with open(PATH_FILE, "rb") as f:
+                paths = [line[:-1].decode("utf-8", "surrogateescape")
+                         for line in itertools.islice(f, total)]
+                # Lines past here (an append that never reached the manifest)
+                # are left alone; the next append overwrites from this offset.
+                end = f.tell()
+            if len(paths) != total:
+                raise ValueError(f"manifest lists {total} rows, paths.txt has {len(paths)}")
+            # Rows are L2-normalized when computed and stored that way, so
+            # similarity is a plain dot product (zero rows for failed images
+            # stay zero). Older float32 shards load as-is.
+            _set_cache(entries, paths, end)  # written already normalized
+            if any(len(a) != e["count"] for a, e in zip(_shards, entries)):
+                raise ValueError("shard sizes do not match the manifest")
+            print(f"[retrieval] Loaded {total} embeddings from {len(entries)} cache shards.")
+            return
         except Exception as e:
             print(f"[retrieval] Failed to load cache: {e}. Resetting.")
-    _embs = np.zeros((0, EMBED_DIM), dtype=np.float32)
-    _paths = []
+    _set_cache([], [], 0)
+    _manifest_stamp = None  # retried on the next load, before any append
 
-def _save_cache():
-    np.save(EMB_FILE, _embs)
-    PATH_FILE.write_text(json.dumps(_paths, indent=2))
-    print(f"[retrieval] Saved {_embs.shape[0]} embeddings to cache.")
+def _append_to_cache(new_paths: List[str], new_embs: np.ndarray):
+    """
+    Persist new rows as one more shard; compacts once MAX_SHARDS is reached.
+    Caller holds _cache_file_lock and has reloaded the cache under it.
+    """
+    stale = []
+    if len(_manifest) >= MAX_SHARDS:
+        stale = [e["file"] for e in _manifest]
+        merged = np.concatenate(_shards + [new_embs], axis=0, dtype=CACHE_DTYPE)
+        entries = [{"file": _write_shard(merged), "start": 0, "count": len(merged)}]
+    else:
+        entries = _manifest + [{"file": _write_shard(new_embs), "start": len(_paths),
+                                "count": len(new_embs)}]
+    # Written from the offset the manifest accounts for, so leftovers of an
+    # interrupted append (or, after a reset, the whole old file) are replaced.
+    with open(PATH_FILE, "r+b" if _manifest and PATH_FILE.exists() else "wb") as f:
+        f.seek(_paths_end if _manifest else 0)
+        f.write("".join(p + "\n" for p in new_paths).encode("utf-8", "surrogateescape"))
+        f.truncate()
+        end = f.tell()
+    _write_manifest(entries)
+    # Unlinking is safe for readers: their memory maps keep the inode alive.
+    for name in stale:
+        (CACHE_DIR / name).unlink(missing_ok=True)
+    # New dict rather than an in-place update: callers use their snapshot
+    # of it outside _cache_lock, together with the matching shard list.
+    path_to_idx = dict(_path_to_idx)
+    path_to_idx.update(zip(new_paths, range(len(_paths), len(_paths) + len(new_paths))))
+    _set_cache(entries, _paths + new_paths, end, path_to_idx)
+    print(f"[retrieval] Saved {len(new_paths)} new embeddings ({len(_paths)} cached).")
 
-def _embed_image(img_path: str) -> np.ndarray:
-    """Compute embedding for a single image."""
-    try:
-        # Resolve relative paths (handle both /images/... and /data/images/...)
-        if not os.path.isabs(img_path):
-            img_path = os.path.join("/data/images", img_path)
-        elif img_path.startswith("/images/"):
-            img_path = img_path.replace("/images/", "/data/images/")
+def _gather(shards: List[np.ndarray], starts: np.ndarray, rows: List[int]) -> np.ndarray:
+    """Cached rows by global index, as float32."""
+    rows = np.asarray(rows, dtype=np.int64)
+    out = np.empty((len(rows), EMBED_DIM), dtype=np.float32)
+    which = np.searchsorted(starts, rows, side="right") - 1
+    for s in np.unique(which):
+        sel = which == s
+        out[sel] = shards[s][rows[sel] - starts[s]]
+    return out
 
-        if not os.path.exists(img_path):
-            raise FileNotFoundError(img_path)
+def _resolve_image_path(img_path: str) -> str:
+    # Resolve relative paths (handle both /images/... and /data/images/...)
+    if not os.path.isabs(img_path):
+        return os.path.join("/data/images", img_path)
+    if img_path.startswith("/images/"):
+        return img_path.replace("/images/", "/data/images/")
+    return img_path
 
+def _decode_cpu(data: torch.Tensor, img_path: str) -> torch.Tensor:
+    """File bytes -> uint8 RGB CHW; PIL only for formats torchvision can't read."""
+    try:
+        return decode_image(data, mode=ImageReadMode.RGB)
+    except RuntimeError:
         img = Image.open(img_path).convert("RGB")
-        img_tensor = preprocess(img).unsqueeze(0).to(DEVICE)
-        with torch.no_grad():
-            emb = model.encode_image(img_tensor)
-            emb /= emb.norm(dim=-1, keepdim=True)
-        return emb.cpu().numpy().astype("float32")[0]
+        return torch.from_numpy(np.asarray(img).copy()).permute(2, 0, 1)
 
+def _load_image_tensor(img_path: str) -> Optional[torch.Tensor]:
+    """CPU preprocessing: decode + resize/crop to uint8 CHW; None if unreadable."""
+    img_path = _resolve_image_path(img_path)
+    try:
+        return resize_crop(_decode_cpu(read_file(img_path), img_path))
     except Exception as e:
         print(f"[retrieval] ⚠️ Failed to embed {img_path}: {e}")
-        return np.zeros((EMBED_DIM,), dtype=np.float32)
+        return None
+
+def _load_image_raw(img_path: str):
+    """
+    Worker side of GPU preprocessing: ("jpeg", file bytes) for nvJPEG, or
+    ("pixels", uint8 CHW tensor) for other formats; None if unreadable.
+    """
+    img_path = _resolve_image_path(img_path)
+    try:
+        data = read_file(img_path)
+        if data[:2].tolist() == [0xFF, 0xD8]:
+            return "jpeg", data
+        return "pixels", _decode_cpu(data, img_path)
+    except Exception as e:
+        print(f"[retrieval] ⚠️ Failed to embed {img_path}: {e}")
+        return None
+
+def _gpu_preprocess_batch(raw: list, ok: List[int]):
+    """Decode (nvJPEG) + preprocess a worker batch on DEVICE; drops undecodable images."""
+    jpegs = [j for j, (kind, _) in enumerate(raw) if kind == "jpeg"]
+    decoded = {}
+    if jpegs:
+        try:
+            decoded = dict(zip(jpegs, decode_jpeg([raw[j][1] for j in jpegs],
+                                                  mode=ImageReadMode.RGB, device=DEVICE)))
+        except RuntimeError as e:
+            print(f"[retrieval] nvJPEG decode failed ({e}); decoding batch on CPU.")
+
+    imgs, keep = [], []
+    for j, (kind, data) in enumerate(raw):
+        img = decoded.get(j) if kind == "jpeg" else data
+        if img is None:
+            try:
+                img = decode_image(data, mode=ImageReadMode.RGB)
+            except RuntimeError as e:
+                print(f"[retrieval] ⚠️ Failed to decode image: {e}")
+                continue
+        imgs.append(resize_crop(img.to(DEVICE, non_blocking=True)))
+        keep.append(ok[j])
+    if not imgs:
+        return None, keep
+    return torch.stack(imgs).float().sub_(_PIXEL_MEAN).div_(_PIXEL_STD), keep
+
+class _ImageDataset(Dataset):
+    """Indexed by a whole batch (list of positions), decoded on a thread pool."""
+    def __init__(self, paths: List[str]):
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idxs: List[int]):
+        load = _load_image_raw if GPU_PREPROCESS else _load_image_tensor
+        paths = [self.paths[i] for i in idxs]
+        if len(paths) == 1 or DECODE_THREADS <= 1:
+            return [load(p) for p in paths]
+        with ThreadPoolExecutor(max_workers=min(DECODE_THREADS, len(paths))) as ex:
+            return list(ex.map(load, paths))
+
+def _collate_images(items):
+    """Stack the readable images; also return their positions in the batch."""
+    ok = [i for i, t in enumerate(items) if t is not None]
+    if not ok:
+        batch = None
+    elif GPU_PREPROCESS:
+        batch = [items[i] for i in ok]  # decoded/preprocessed on the device
+    else:
+        batch = torch.stack([items[i] for i in ok])
+    return batch, ok, len(items)
+
+def _encode_into(out: np.ndarray, batch: torch.Tensor, ok: List[int], start: int, ready=None):
+    """Encode a prepared batch into rows start + ok of out (after `ready`, if given)."""
+    if ready is not None:
+        torch.cuda.current_stream().wait_event(ready)
+    emb = _encode(batch.to(DEVICE, non_blocking=True)).float()
+    emb /= emb.norm(dim=-1, keepdim=True)
+    out[start + np.asarray(ok)] = emb.cpu().numpy()
+
+def _embed_images(img_paths: List[str], dtype=np.float32) -> np.ndarray:
+    """
+    Compute normalized embeddings for many images, EMBED_BATCH_SIZE per
+    forward pass. File reads (and, on CPU, decode + resize) run in
+    DataLoader workers so they overlap the model; on CUDA the pixels are
+    decoded/preprocessed on the device (see GPU_PREPROCESS). Batches are
+    written straight into one preallocated (len, EMBED_DIM) array of `dtype`;
+    rows for images that could not be read stay zero.
+    """
+    out = np.zeros((len(img_paths), EMBED_DIM), dtype=dtype)
+    if not img_paths:
+        return out
+    workers = EMBED_WORKERS if len(img_paths) > EMBED_BATCH_SIZE else 0
+    # batch_size=None + a BatchSampler: each worker fetch is one whole batch,
+    # so its images can be decoded concurrently.
+    loader = DataLoader(
+        _ImageDataset(img_paths),
+        batch_size=None,
+        sampler=BatchSampler(range(len(img_paths)), EMBED_BATCH_SIZE, drop_last=False),
+        num_workers=workers,
+        # Pinning only pays off when worker prefetch overlaps the copy; for a
+        # single query it would be a synchronous extra copy.
+        pin_memory=DEVICE == "cuda" and workers > 0,
+        prefetch_factor=4 if workers else None,
+        collate_fn=_collate_images,
+    )
+    start, pending = 0, None
+    # FP16 forward on CUDA (tensor cores); normalized in float32.
+    with torch.no_grad(), torch.autocast(device_type="cuda", dtype=torch.float16,
+                                         enabled=DEVICE == "cuda"):
+        for batch, ok, size in tqdm(loader, desc="Embedding new images", disable=len(img_paths) <= 1):
+            ready = None
+            if GPU_PREPROCESS and ok:
+                with torch.cuda.stream(_prep_stream):
+                    batch, ok = _gpu_preprocess_batch(batch, ok)
+                    ready = _prep_stream.record_event()
+                if batch is not None:
+                    # Allocated on the side stream, consumed on the default one.
+                    batch.record_stream(torch.cuda.current_stream())
+            elif ok:
+                batch = batch.float().sub_(_PIXEL_MEAN).div_(_PIXEL_STD)
+            # The previous batch is encoded only now, so its forward pass
+            # overlaps this batch's preprocessing.
+            if pending is not None:
+                _encode_into(out, *pending)
+            pending = (batch, ok, start, ready) if ok else None
+            start += size
+        if pending is not None:
+            _encode_into(out, *pending)
+    return out
+
+def _embed_image(img_path: str) -> np.ndarray:
+    """Compute embedding for a single image."""
+    return _embed_images([img_path])[0]
 
 
 def _ensure_embeddings(paths: List[str]):
-    global _embs, _paths
+    """Embed and cache whichever of `paths` (already normalized) are new."""
     _load_cache()
-    paths = [_norm_path(p) for p in paths]
-    known = set(_paths)
-    new_paths = [p for p in paths if p not in known]
+    known = _path_to_idx
+    # paths.txt is line-based; a (pathological) name with a newline is never
+    # cached and so never returned as a candidate.
+    new_paths = list(dict.fromkeys(p for p in paths if p not in known and "\n" not in p))
     if not new_paths:
         return
     print(f"[retrieval] Computing embeddings for {len(new_paths)} new images...")
-    new_embs = []
-    for p in tqdm(new_paths, desc="Embedding new images"):
-        new_embs.append(_embed_image(p))
-    new_embs = np.stack(new_embs, axis=0)
-    if _embs.size == 0:
-        _embs = new_embs
-        _paths = list(new_paths)
+    embs = _embed_images(new_paths, dtype=CACHE_DTYPE)
+    with _cache_file_lock():
+        # Another process may have appended while these were embedded.
+        _reload_cache()
+        keep = [i for i, p in enumerate(new_paths) if p not in _path_to_idx]
+        if keep:
+            _append_to_cache([new_paths[i] for i in keep], embs[keep])
+
+def _top_candidates(q_embs: np.ndarray, candidates: np.ndarray, m: int):
+    """
+    Best m candidates per query row, best first, as (scores, positions).
+    Stored embeddings are L2-normalized, so the inner product is the cosine
+    similarity: with FAISS a flat inner-product kNN does the product and the
+    top-m selection in one pass. Otherwise only the m best per row are found
+    (argpartition, O(N)) and sorted, instead of argsorting all N candidates.
+    """
+    if m <= 0:
+        return np.zeros((len(q_embs), 0)), np.zeros((len(q_embs), 0), dtype=np.int64)
+    if faiss is not None:
+        return faiss.knn(q_embs, candidates, m, metric=faiss.METRIC_INNER_PRODUCT)
+
+    sims = q_embs @ candidates.T
+    n = sims.shape[1]
+    if m < n:
+        best = np.argpartition(-sims, m - 1, axis=1)[:, :m]
     else:
-        _embs = np.concatenate([_embs, new_embs], axis=0)
-        _paths.extend(new_paths)
-    _save_cache()
+        best = np.broadcast_to(np.arange(n), sims.shape)
+    rows = np.arange(len(sims))[:, None]
+    best = best[rows, np.argsort(-sims[rows, best], axis=1)]
+    return sims[rows, best], best
 
 # ============================================================
 # PUBLIC API
 # ============================================================
 def top_k_similar(query_path: str, all_paths: List[str], k: int = 5, exclude_self: bool = True) -> List[Dict[str, float]]:
-    all_paths = [_norm_path(p) for p in all_paths]
-    _ensure_embeddings(all_paths)
+    return top_k_similar_batch([query_path], all_paths, k=k, exclude_self=exclude_self)[0]
 
-    path_to_idx = {p: i for i, p in enumerate(_paths)}
-    q_abs = _norm_path(query_path)
-    if q_abs in path_to_idx:
-        q_emb = _embs[path_to_idx[q_abs]]
-    else:
-        q_emb = _embed_image(q_abs)
+def top_k_similar_batch(query_paths: List[str], all_paths: List[str], k: int = 5,
+                        exclude_self: bool = True) -> List[List[Dict[str, float]]]:
+    """
+    top_k_similar for several queries against the same candidate list: the
+    cache is checked once and all similarities come from one (M, N) product.
+    Returns one result list per query, in order.
+    """
+    all_paths = [_norm_path(p) for p in all_paths]
+    with _cache_lock:
+        _ensure_embeddings(all_paths)
+        shards, starts = _shards, _shard_starts
+        path_to_idx = _path_to_idx
 
-    idxs = [path_to_idx[p] for p in all_paths if p in path_to_idx]
-    if not idxs:
+    # Candidates that have a cached row, and those rows (same order).
+    cand_paths = [p for p in all_paths if p in path_to_idx]
+    idxs = np.fromiter((path_to_idx[p] for p in cand_paths), dtype=np.int64, count=len(cand_paths))
+    if not len(idxs):
         print("[retrieval] No valid embeddings for provided paths.")
-        return []
+        return [[] for _ in query_paths]
 
-    candidates = _embs[idxs]
-    sims = cosine_similarity(q_emb.reshape(1, -1), candidates)[0]
+    q_abs = [_norm_path(q) for q in query_paths]
+    # Cached queries are gathered, the rest embedded together in batches.
+    hit = np.fromiter((q in path_to_idx for q in q_abs), dtype=bool, count=len(q_abs))
+    q_embs = np.empty((len(q_abs), EMBED_DIM), dtype=np.float32)
+    q_embs[hit] = _gather(shards, starts, [path_to_idx[q] for q, h in zip(q_abs, hit) if h])
+    q_embs[~hit] = _embed_images([q for q, h in zip(q_abs, hit) if not h])
 
-    if exclude_self and q_abs in path_to_idx and path_to_idx[q_abs] in idxs:
-        sims[idxs.index(path_to_idx[q_abs])] = -1.0
+    candidates = _gather(shards, starts, idxs)
+    # One spare per row so the query itself can be dropped afterwards.
+    m = min(k + 1 if exclude_self else k, len(idxs))
+    scores, best = _top_candidates(q_embs, candidates, m)
 
-    order = np.argsort(-sims)[:k]
-    top_scores = sims[order]
-    top_paths = [all_paths[i] for i in order]
+    results = []
+    for row, q in enumerate(q_abs):
+        order, top_scores = best[row], scores[row]
+        if exclude_self and q in path_to_idx:
+            # Only the m selected rows are compared against the query's row.
+            keep = idxs[order] != path_to_idx[q]
+            order, top_scores = order[keep], top_scores[keep]
+        order, top_scores = order[:k], top_scores[:k]
+        top_paths = [cand_paths[i] for i in order]
 
-    probs = np.clip(top_scores, 0, None)
-    if probs.sum() > 0:
-        probs = probs / probs.sum()
+        # "score" is the cosine similarity; "prob" spreads the non-negative
+        # scores over the k hits (uniform if none is positive).
+        pos = top_scores.clip(min=0)
+        total = pos.sum()
+        probs = pos / total if total > 0 else np.full(len(pos), 1.0 / max(len(pos), 1))
 
-    return [{"path": top_paths[i], "score": float(probs[i])} for i in range(len(top_paths))]
+        results.append([{"path": p, "score": float(sc), "prob": float(pr)}
+                        for p, sc, pr in zip(top_paths, top_scores, probs)])
+    return results
 
 # ============================================================
 # MANUAL TEST
@@ -0,0 +1,105 @@
+import json
+import sys
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import auth  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+
+
+def _signed(payload_json: str, header: bytes = auth.HEADER_B64) -> str:
+    """Token with a valid signature over an arbitrary header/payload."""
+    signing_input = header + b"." + auth._b64encode(payload_json.encode())
+    return (signing_input + b"." + auth._b64encode(auth._sign(signing_input))).decode()
+
+
+class DecodeTokenTests(unittest.TestCase):
+    def test_round_trip(self):
+        payload = auth.decode_token(auth.create_token("alice"))
+        self.assertEqual(payload["sub"], "alice")
+
+    def test_forged_signature(self):
+        header, payload, sig = auth.create_token("alice").split(".")
+        forged = auth._b64encode(b"\0" * 32).decode()
+        with self.assertRaises(ValueError):
+            auth.decode_token(f"{header}.{payload}.{forged}")
+
+    def test_tampered_payload(self):
+        header, _, sig = auth.create_token("alice").split(".")
+        other = auth._b64encode(json.dumps({"sub": "admin", "exp": time.time() + 60}).encode()).decode()
+        with self.assertRaises(ValueError):
+            auth.decode_token(f"{header}.{other}.{sig}")
+
+    def test_wrong_header(self):
+        none_header = auth._b64encode(b'{"alg":"none","typ":"JWT"}')
+        with self.assertRaises(ValueError):
+            auth.decode_token(_signed(json.dumps({"exp": time.time() + 60}), header=none_header))
+
+    def test_malformed(self):
+        for token in ("", "a.b", "a.b.c.d", "!!!.???.###"):
+            with self.assertRaises(ValueError):
+                auth.decode_token(token)
+
+    def test_expired(self):
+        with self.assertRaises(ValueError):
+            auth.decode_token(auth.create_token("alice", expires_in=-1))
+
+    def test_non_dict_payload(self):
+        for payload in ("[1, 2]", '"x"', "42", "null"):
+            with self.assertRaises(ValueError):
+                auth.decode_token(_signed(payload))
+
+    def test_missing_or_bad_exp(self):
+        for payload in ('{"sub": "a"}', '{"exp": "9999999999"}', '{"exp": true}'):
+            with self.assertRaises(ValueError):
+                auth.decode_token(_signed(payload))
+
+    def test_non_finite_exp(self):
+        for exp in ("NaN", "Infinity", "1e400"):
+            with self.assertRaises(ValueError):
+                auth.decode_token(_signed('{"sub": "a", "exp": %s}' % exp))
+
+
+class VerifyTokenCacheTests(unittest.TestCase):
+    def setUp(self):
+        auth._token_cache.clear()
+
+    def test_bad_scheme_and_token_are_401(self):
+        token = auth.create_token("alice")
+        for header in (f"Basic {token}", "Bearer not.a.token", "Bearer"):
+            with self.assertRaises(HTTPException) as ctx:
+                auth.verify_token(header)
+            self.assertEqual(ctx.exception.status_code, 401)
+        self.assertEqual(len(auth._token_cache), 0)  # failures are never cached
+
+    def test_cached_until_ttl(self):
+        token = auth.create_token("alice", expires_in=3600)
+        now = time.time()
+        with mock.patch("auth.time.time", return_value=now):
+            self.assertEqual(auth.verify_token(f"Bearer {token}")["sub"], "alice")
+        self.assertIn(token, auth._token_cache)
+
+        with mock.patch("auth.decode_token", side_effect=AssertionError("not cached")):
+            with mock.patch("auth.time.time", return_value=now + auth.TOKEN_CACHE_TTL - 1):
+                self.assertEqual(auth.verify_token(f"Bearer {token}")["sub"], "alice")
+        self.assertIsNone(auth._cache_get(token, now + auth.TOKEN_CACHE_TTL))
+        self.assertNotIn(token, auth._token_cache)
+
+    def test_cache_entry_never_outlives_token(self):
+        token = auth.create_token("alice", expires_in=5)
+        now = time.time()
+        with mock.patch("auth.time.time", return_value=now):
+            auth.verify_token(f"Bearer {token}")
+        _, expires_at = auth._token_cache[token]
+        self.assertLessEqual(expires_at, now + 5)
+        with mock.patch("auth.time.time", return_value=now + 6):
+            with self.assertRaises(HTTPException):
+                auth.verify_token(f"Bearer {token}")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,439 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from pathlib import Path
+from unittest import mock
+
+# main reads these at import (and mkdirs them); keep it off /data.
+_TMP = tempfile.mkdtemp(prefix="labeling-test-")
+os.environ.setdefault("IMAGE_ROOT", os.path.join(_TMP, "images"))
+os.environ.setdefault("UPLOAD_ROOT", os.path.join(_TMP, "uploads"))
+os.environ.setdefault("WATCH_IMAGES", "0")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import orjson  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+
+import main  # noqa: E402
+
+
+def _urls(n: int):
+    return tuple(f"/images/img_{i:03d}.jpg" for i in range(n))
+
+
+def _request(if_none_match: str = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+def _touch(root: str, rel: str):
+    path = os.path.join(root, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+
+
+def _fresh_session_cache(case: unittest.TestCase):
+    for name, value in (("_session_cache", main.OrderedDict()), ("_session_cache_version", 0)):
+        patcher = mock.patch.object(main, name, value)
+        patcher.start()
+        case.addCleanup(patcher.stop)
+
+
+class _ImageRootCase(unittest.TestCase):
+    """Each test gets an empty IMAGE_ROOT and a fresh image list."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp(dir=_TMP)
+        patcher = mock.patch.object(main, "IMAGE_ROOT", self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        main.set_image_list([])
+
+
+class SessionPageTests(unittest.TestCase):
+    @staticmethod
+    def _reference(urls, index, limit):
+        # The slicing version the one-pass window replaced.
+        query = urls[index]
+        start = (index + 1) % len(urls)
+        page = list(urls[start:start + limit])
+        if len(page) < limit:
+            page += urls[0:limit - len(page)]
+        return {"queryImage": query, "images": [u for u in page if u != query]}
+
+    def setUp(self):
+        _fresh_session_cache(self)
+
+    def test_window_matches_slices(self):
+        for n in range(1, 10):
+            urls = _urls(n)
+            for index in range(n):
+                for limit in range(1, 2 * n + 3):
+                    body, _ = main._build_session_page(urls, index, limit)
+                    self.assertEqual(orjson.loads(body), self._reference(urls, index, limit),
+                                     (n, index, limit))
+
+    def test_empty_list(self):
+        with self.assertRaises(ValueError):
+            main._build_session_page((), 0, 5)
+
+    def test_cached_page_matches_its_snapshot(self):
+        old = _urls(5)
+        new = tuple(u.replace("img_", "new_") for u in old)
+        body, _ = main._session_page(old, 1, 4, 2)
+        self.assertEqual(orjson.loads(body)["queryImage"], old[4])
+        # Same (index, limit) under a newer version: not the old version's entry.
+        body, _ = main._session_page(new, 2, 4, 2)
+        self.assertEqual(orjson.loads(body)["queryImage"], new[4])
+        # A request still holding the older snapshot gets its own page, uncached.
+        body, _ = main._session_page(old, 1, 4, 2)
+        self.assertEqual(orjson.loads(body)["queryImage"], old[4])
+        self.assertEqual(main._session_cache[(4, 2)][0], main._build_session_page(new, 4, 2)[0])
+
+    def test_get_session_uses_one_snapshot(self):
+        urls = _urls(4)
+        with mock.patch.object(main, "IMAGE_SNAPSHOT", (urls, 1)):
+            resp = main.get_session(_request(), offset=6, limit=3, user=None)
+        self.assertEqual(orjson.loads(resp.body), self._reference(urls, 2, 3))
+        with mock.patch.object(main, "IMAGE_SNAPSHOT", ((), 2)):
+            with self.assertRaises(HTTPException) as ctx:
+                main.get_session(_request(), offset=0, limit=3, user=None)
+        self.assertEqual(ctx.exception.status_code, 404)
+
+
+class ETagTests(unittest.TestCase):
+    def setUp(self):
+        self.body = b'{"a":1}'
+        self.etag = main._etag(self.body)
+        _fresh_session_cache(self)
+
+    def test_200_with_etag(self):
+        resp = main.cached_json_response(_request(), self.body, self.etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.body, self.body)
+        self.assertEqual(resp.headers["etag"], self.etag)
+        self.assertEqual(resp.headers["cache-control"], main.BATCH_CACHE_CONTROL)
+
+    def test_304_on_match(self):
+        for inm in (self.etag, f'"x", {self.etag}', f"W/{self.etag}", "*"):
+            resp = main.cached_json_response(_request(inm), self.body, self.etag)
+            self.assertEqual(resp.status_code, 304, inm)
+            self.assertEqual(resp.body, b"")
+            self.assertEqual(resp.headers["etag"], self.etag)
+
+    def test_200_on_mismatch(self):
+        resp = main.cached_json_response(_request('"stale"'), self.body, self.etag)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_session_revalidation(self):
+        urls = _urls(6)
+        with mock.patch.object(main, "IMAGE_SNAPSHOT", (urls, 1)):
+            first = main.get_session(_request(), offset=1, limit=2, user=None)
+            again = main.get_session(_request(first.headers["etag"]), offset=1, limit=2, user=None)
+            other = main.get_session(_request(first.headers["etag"]), offset=2, limit=2, user=None)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(other.status_code, 200)
+
+
+class ScanTests(_ImageRootCase):
+    def setUp(self):
+        super().setUp()
+        cache_file = Path(self.root + ".scan_cache.json")
+        for name, value in (("SCAN_CACHE_FILE", cache_file), ("_scan_cache", {})):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_lists_images_only(self):
+        for rel in ("b.jpg", "a.PNG", "sub/deep/c.webp", "notes.txt", ".png", "sub/._x"):
+            _touch(self.root, rel)
+        expected = ["a.PNG", "b.jpg", "sub/deep/c.webp"]
+        for workers in (1, 4):
+            self.assertEqual(main.scan_images(self.root, workers=workers), expected)
+
+    def test_unchanged_directory_is_not_listed(self):
+        _touch(self.root, "sub/a.jpg")
+        sub = os.path.join(self.root, "sub")
+        os.utime(sub, ns=(10**18, 10**18))  # well outside MTIME_SLACK_NS
+        cache = {}
+        main.scan_images(self.root, workers=1, cache=cache)
+        self.assertEqual(cache["sub/"][0], 10**18)
+        # A reused entry is returned as cached, without listing the directory.
+        cache["sub/"][1] = ["sub/cached.jpg"]
+        self.assertEqual(main.scan_images(self.root, workers=1, cache=cache), ["sub/cached.jpg"])
+        os.utime(sub, ns=(10**18 + 1, 10**18 + 1))
+        self.assertEqual(main.scan_images(self.root, workers=1, cache=cache), ["sub/a.jpg"])
+
+    def test_recently_changed_directory_is_never_reused(self):
+        _touch(self.root, "a.jpg")
+        cache = {}
+        main.scan_images(self.root, workers=1, cache=cache)
+        self.assertEqual(cache[""][0], -1)
+
+    def test_rescan_reports_new_paths(self):
+        _touch(self.root, "a.jpg")
+        _touch(self.root, "sub/b.png")
+        self.assertEqual(main.rescan_images(), ["a.jpg", "sub/b.png"])
+        self.assertEqual(main.IMAGE_LIST, ("a.jpg", "sub/b.png"))
+        self.assertEqual(main.IMAGE_LIST_URLS, ("/images/a.jpg", "/images/sub/b.png"))
+        _touch(self.root, "sub/c.jpg")
+        os.remove(os.path.join(self.root, "a.jpg"))
+        self.assertEqual(main.rescan_images(), ["sub/c.jpg"])
+        self.assertEqual(main.IMAGE_LIST, ("sub/b.png", "sub/c.jpg"))
+        self.assertEqual(main.rescan_images(), [])
+
+    def test_scan_cache_round_trip(self):
+        _touch(self.root, "a.jpg")
+        main.rescan_images()
+        saved = dict(main._scan_cache)
+        main._scan_cache.clear()
+        main._load_scan_cache()
+        self.assertEqual(main._scan_cache, saved)
+        # A cache written for another IMAGE_ROOT is ignored.
+        main._scan_cache.clear()
+        with mock.patch.object(main, "IMAGE_ROOT", self.root + "-other"):
+            main._load_scan_cache()
+        self.assertEqual(main._scan_cache, {})
+
+
+class ImageListTests(_ImageRootCase):
+    def _check_aligned(self):
+        self.assertEqual(list(main.IMAGE_LIST), sorted(main.IMAGE_LIST))
+        self.assertEqual(main.IMAGE_LIST_URLS, tuple("/images/" + p for p in main.IMAGE_LIST))
+        self.assertEqual(main.IMAGE_SNAPSHOT, (main.IMAGE_LIST_URLS, main.IMAGE_LIST_VERSION))
+
+    def test_add_many_merges_in_order(self):
+        main.set_image_list(["b.jpg", "d.jpg", "f.jpg"])
+        self.assertTrue(main._image_list_add_many(["e.jpg", "a.jpg", "sub/c.jpg", "e.jpg", "b.jpg"]))
+        self.assertEqual(main.IMAGE_LIST, ("a.jpg", "b.jpg", "d.jpg", "e.jpg", "f.jpg", "sub/c.jpg"))
+        self._check_aligned()
+
+    def test_add_many_into_empty_list(self):
+        self.assertTrue(main._image_list_add_many(["b.jpg", "a.jpg"]))
+        self.assertEqual(main.IMAGE_LIST, ("a.jpg", "b.jpg"))
+        self._check_aligned()
+
+    def test_no_op_keeps_version(self):
+        main.set_image_list(["a.jpg"])
+        version = main.IMAGE_LIST_VERSION
+        self.assertFalse(main._image_list_add_many(["a.jpg"]))
+        self.assertFalse(main._image_list_add_many([]))
+        self.assertFalse(main._image_list_remove_many(["zzz.jpg"]))
+        self.assertEqual(main.IMAGE_LIST_VERSION, version)
+
+    def test_remove_many(self):
+        main.set_image_list(["a.jpg", "b.jpg", "c.jpg", "d.jpg"])
+        version = main.IMAGE_LIST_VERSION
+        self.assertTrue(main._image_list_remove_many(["d.jpg", "b.jpg", "missing.jpg"]))
+        self.assertEqual(main.IMAGE_LIST, ("a.jpg", "c.jpg"))
+        self.assertEqual(main.IMAGE_LIST_VERSION, version + 1)
+        self._check_aligned()
+        self.assertTrue(main._image_list_remove_many(["a.jpg", "c.jpg"]))
+        self.assertEqual(main.IMAGE_LIST, ())
+        self._check_aligned()
+
+
+class ZipImportTests(_ImageRootCase):
+    def _zip(self, members) -> Path:
+        path = Path(tempfile.mkdtemp(dir=_TMP)) / "upload.zip"
+        with zipfile.ZipFile(path, "w") as zf:
+            for name, data in members:
+                zf.writestr(name, data)
+        return path
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(main, "_next_image_idx", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_extract_sanitizes_names(self):
+        zip_path = self._zip([("dir/", b""), ("a/x.jpg", b"x"), ("../../evil.png", b"e")])
+        out = Path(tempfile.mkdtemp(dir=_TMP))
+        extracted = main.safe_extract_zip(zip_path, out)
+        self.assertEqual(sorted(p.name for p in extracted), ["evil.png", "x.jpg"])
+        self.assertEqual(sorted(os.listdir(out)), ["evil.png", "x.jpg"])
+        self.assertEqual((out / "x.jpg").read_bytes(), b"x")
+
+    def test_extract_dest_for_and_include(self):
+        zip_path = self._zip([("a.jpg", b"1"), ("notes.txt", b"n"), ("b.PNG", b"2")])
+        out = Path(tempfile.mkdtemp(dir=_TMP))
+        extracted = main.safe_extract_zip(
+            zip_path, out,
+            dest_for=lambda fn: out / ("renamed_" + fn),
+            include=main.is_image_name)
+        self.assertEqual(extracted, [out / "renamed_a.jpg", out / "renamed_b.PNG"])
+        self.assertEqual(sorted(os.listdir(out)), ["renamed_a.jpg", "renamed_b.PNG"])
+
+    def test_import_names_only_images(self):
+        _touch(self.root, "img_007.jpg")
+        main.seed_next_image_index(["img_007.jpg"])
+        zip_path = self._zip([
+            ("photos/a.JPG", b"a"), (".DS_Store", b""), ("__MACOSX/photos/._a.JPG", b"fork"),
+            ("readme.txt", b"r"), ("photos/b.png", b"b"),
+        ])
+        self.assertEqual(main.import_zip_images(zip_path), ["/images/img_008.jpg", "/images/img_009.png"])
+        self.assertEqual(sorted(os.listdir(self.root)), ["img_007.jpg", "img_008.jpg", "img_009.png"])
+        self.assertEqual(Path(self.root, "img_008.jpg").read_bytes(), b"a")
+
+    def test_import_without_images_is_400(self):
+        with self.assertRaises(HTTPException) as ctx:
+            main.import_zip_images(self._zip([("readme.txt", b"r")]))
+        self.assertEqual(ctx.exception.status_code, 400)
+        self.assertEqual(os.listdir(self.root), [])
+
+
+@unittest.skipIf(main.Observer is None, "watchdog is not installed")
+class ImageWatcherTests(_ImageRootCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(main, "WATCH_DEBOUNCE", 3600)  # flushed by hand
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = main.ImageTreeHandler()
+        self.addCleanup(lambda: self.handler._timer and self.handler._timer.cancel())
+
+    def _path(self, rel: str) -> str:
+        return os.path.join(self.root, rel)
+
+    def test_events_are_applied_in_one_flush(self):
+        main.set_image_list(["keep.jpg", "old.jpg"])
+        self.handler.on_closed(main.FileClosedEvent(self._path("b.jpg")))
+        self.handler.on_closed(main.FileClosedEvent(self._path("sub/a.png")))
+        self.handler.on_closed(main.FileClosedEvent(self._path("notes.txt")))
+        self.handler.on_deleted(main.FileDeletedEvent(self._path("old.jpg")))
+        self.handler.on_closed(main.FileClosedEvent(self._path("gone.jpg")))
+        self.handler.on_deleted(main.FileDeletedEvent(self._path("gone.jpg")))  # latest event wins
+        self.assertEqual(main.IMAGE_LIST, ("keep.jpg", "old.jpg"))  # nothing applied yet
+        self.handler.flush()
+        self.assertEqual(main.IMAGE_LIST, ("b.jpg", "keep.jpg", "sub/a.png"))
+        self.assertIsNone(self.handler._timer)
+
+    def test_created_waits_for_close_on_inotify(self):
+        event = main.FileCreatedEvent(self._path("a.jpg"))
+        with mock.patch.object(main, "WATCH_CLOSE_EVENTS", True):
+            self.handler.on_created(event)
+        self.handler.flush()
+        self.assertEqual(main.IMAGE_LIST, ())
+        with mock.patch.object(main, "WATCH_CLOSE_EVENTS", False):
+            self.handler.on_created(event)
+        self.handler.flush()
+        self.assertEqual(main.IMAGE_LIST, ("a.jpg",))
+
+    def test_moves(self):
+        main.set_image_list(["a.jpg", "out.jpg"])
+        self.handler.on_moved(main.FileMovedEvent(self._path("a.jpg"), self._path("z.jpg")))
+        self.handler.on_moved(main.FileMovedEvent("", self._path("in.png")))  # moved into the tree
+        self.handler.on_moved(main.FileMovedEvent(self._path("out.jpg"), ""))  # moved out of it
+        self.handler.on_moved(main.FileMovedEvent(self._path("x.tmp"), self._path("saved.jpg")))
+        self.handler.flush()
+        self.assertEqual(main.IMAGE_LIST, ("in.png", "saved.jpg", "z.jpg"))
+
+    def test_flush_waits_for_a_rescan(self):
+        self.handler.on_closed(main.FileClosedEvent(self._path("a.jpg")))
+        with main._scan_lock:
+            t = threading.Thread(target=self.handler.flush)
+            t.start()
+            t.join(0.2)
+            self.assertTrue(t.is_alive())
+            main.set_image_list(["b.jpg"])  # what a rescan that missed a.jpg would publish
+        t.join()
+        self.assertEqual(main.IMAGE_LIST, ("a.jpg", "b.jpg"))
+
+
+class ImageNamingTests(_ImageRootCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(main, "_next_image_idx", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_next_image_index(self):
+        self.assertEqual(main.get_next_image_index(Path(self.root)), 1)
+        for name in ("img_009.jpg", "img_12.png", "img_x.jpg", "other_99.jpg"):
+            _touch(self.root, name)
+        self.assertEqual(main.get_next_image_index(Path(self.root)), 13)
+
+    def test_seed_ignores_subdirectories(self):
+        main.seed_next_image_index(["img_004.jpg", "sub/img_900.jpg", "img_002.png", "x.jpg"])
+        self.assertEqual(main._next_image_idx, 5)
+        main.seed_next_image_index(["img_050.jpg"])  # only the first seed counts
+        self.assertEqual(main._next_image_idx, 5)
+
+    def test_counter_advances_without_listing(self):
+        main.seed_next_image_index([])
+        self.assertEqual(main.next_image_path(".jpg")[0], "img_001.jpg")
+        self.assertEqual(main.next_image_path(".png"), ("img_002.png", Path(self.root) / "img_002.png"))
+
+    def test_number_taken_under_any_extension(self):
+        main.seed_next_image_index([])
+        # Copied in by hand after the seed: each claims its number.
+        for name in ("img_001.png", "img_002.JPEG", "img_003.gif", "img_004.txt"):
+            _touch(self.root, name)
+        self.assertEqual(main.next_image_path(".jpg")[0], "img_004.jpg")
+        _touch(self.root, "img_005.tiff")
+        self.assertEqual(main.next_image_path(".tiff")[0], "img_006.tiff")
+
+    def test_first_use_without_seed_lists_root(self):
+        _touch(self.root, "img_041.webp")
+        self.assertEqual(main.next_image_path(".jpg")[0], "img_042.jpg")
+
+
+class BatchLogTests(unittest.TestCase):
+    def setUp(self):
+        tmp = Path(tempfile.mkdtemp(dir=_TMP))
+        self.base = [{"queryImage": "/images/q0.jpg", "images": ["/images/a.jpg"]},
+                     {"queryImage": "/images/q1.jpg", "images": []}]
+        for name, value in (("BATCH_FILE", tmp / "batches.py"), ("BATCH_LOG_FILE", tmp / "batches.jsonl"),
+                            ("BATCHES", []), ("BATCH_RESPONSES", []), ("BATCH_INDEX", {}),
+                            ("BATCH_COUNT_RESPONSE", (b"", ""))):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.set_batches(list(self.base))
+
+    def _check_published(self):
+        self.assertEqual(main.BATCH_RESPONSES, [main._batch_response(b) for b in main.BATCHES])
+        self.assertEqual(orjson.loads(main.BATCH_COUNT_RESPONSE[0]), {"total": len(main.BATCHES)})
+        for b in main.BATCHES:
+            self.assertEqual(main.BATCHES[main.BATCH_INDEX[b["queryImage"]]], b)
+
+    def test_save_appends_and_replaces(self):
+        q2 = {"queryImage": "/images/q2.jpg", "images": []}
+        q0 = {"queryImage": "/images/q0.jpg", "images": ["/images/b.jpg"]}
+        q3 = {"queryImage": "/images/q3.jpg", "images": ["/images/c.jpg"]}
+        main.save_batches([(2, q2)])
+        main.save_batches([(0, q0), (3, q3)])
+        self.assertEqual(main.BATCHES, [q0, self.base[1], q2, q3])
+        self._check_published()
+        self.assertEqual(len(main.BATCH_LOG_FILE.read_bytes().splitlines()), 3)
+
+    def test_log_replays_over_base(self):
+        main.save_batches([(2, {"queryImage": "/images/q2.jpg", "images": []})])
+        main.save_batches([(1, {"queryImage": "/images/q1.jpg", "images": ["/images/x.jpg"]})])
+        with open(main.BATCH_LOG_FILE, "ab") as f:
+            f.write(b'{"index": 3, "batch": {"queryIm')  # torn by a crash
+        self.assertEqual(main._apply_batch_log(list(self.base)), main.BATCHES)
+
+    def test_index_past_end_writes_nothing(self):
+        with self.assertRaises(IndexError):
+            main.save_batches([(5, {"queryImage": "/images/q5.jpg", "images": []})])
+        self.assertFalse(main.BATCH_LOG_FILE.exists())
+        self.assertEqual(main.BATCHES, self.base)
+
+    def test_compact(self):
+        main.save_batches([(2, {"queryImage": "/images/q2.jpg", "images": []})])
+        main.compact_batches()
+        self.assertFalse(main.BATCH_LOG_FILE.exists())
+        scope = {}
+        exec(main.BATCH_FILE.read_text(encoding="utf-8"), scope)
+        self.assertEqual(scope["BATCHES"], main.BATCHES)
+        self.assertEqual(main._apply_batch_log(list(scope["BATCHES"])), main.BATCHES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import orjson  # noqa: E402
+
+try:
+    import numpy as np
+    import retrieval  # loads the CLIP weights; needs torch, open_clip and the model files
+except (ImportError, RuntimeError) as e:
+    retrieval = None
+    _SKIP_REASON = f"retrieval unavailable: {e}"
+else:
+    _SKIP_REASON = ""
+
+
+@unittest.skipIf(retrieval is None, _SKIP_REASON)
+class EmbeddingCacheTests(unittest.TestCase):
+    """Shard/manifest persistence only; embeddings are made-up unit rows."""
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp(prefix="embeddings-test-"))
+        names = {
+            "CACHE_DIR": self.dir,
+            "MANIFEST_FILE": self.dir / "manifest.json",
+            "PATH_FILE": self.dir / "paths.txt",
+            "LOCK_FILE": self.dir / ".lock",
+            "LEGACY_EMB_FILE": self.dir / "embeddings.npy",
+            "LEGACY_PATH_FILE": self.dir / "paths.json",
+        }
+        # The in-memory cache state is restored after each test as well.
+        for name in ("_manifest", "_shards", "_shard_starts", "_paths", "_paths_end",
+                     "_path_to_idx", "_manifest_stamp"):
+            names[name] = getattr(retrieval, name)
+        for name, value in names.items():
+            patcher = mock.patch.object(retrieval, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        retrieval._set_cache([], [], 0)
+        self.rng = np.random.default_rng(0)
+
+    def _rows(self, n: int) -> np.ndarray:
+        rows = self.rng.standard_normal((n, retrieval.EMBED_DIM)).astype(np.float32)
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        return rows.astype(retrieval.CACHE_DTYPE)
+
+    def _append(self, paths, rows):
+        with retrieval._cache_file_lock():
+            retrieval._reload_cache()
+            retrieval._append_to_cache(paths, rows)
+
+    def _reload_from_disk(self):
+        retrieval._set_cache([], [], 0)
+        retrieval._manifest_stamp = None
+        retrieval._load_cache()
+
+    def _cached(self, paths) -> np.ndarray:
+        idx = [retrieval._path_to_idx[p] for p in paths]
+        return retrieval._gather(retrieval._shards, retrieval._shard_starts, idx)
+
+    def test_round_trip(self):
+        a, b = self._rows(3), self._rows(2)
+        self._append(["/x/a0", "/x/a1", "/x/a2"], a)
+        self._append(["/x/b0", "/x/b1"], b)
+        self._reload_from_disk()
+        self.assertEqual(retrieval._paths, ["/x/a0", "/x/a1", "/x/a2", "/x/b0", "/x/b1"])
+        self.assertEqual([e["count"] for e in retrieval._manifest], [3, 2])
+        np.testing.assert_array_equal(self._cached(retrieval._paths),
+                                      np.concatenate([a, b]).astype(np.float32))
+
+    def test_compacts_at_max_shards(self):
+        batches = [self._rows(2) for _ in range(3)]
+        with mock.patch.object(retrieval, "MAX_SHARDS", 2):
+            for n, rows in enumerate(batches):
+                self._append([f"/x/{n}_0", f"/x/{n}_1"], rows)
+        self.assertEqual(len(retrieval._manifest), 1)
+        self.assertEqual(sorted(p.name for p in self.dir.glob("shard_*.npy")),
+                         [retrieval._manifest[0]["file"]])
+        self._reload_from_disk()
+        np.testing.assert_array_equal(self._cached(retrieval._paths),
+                                      np.concatenate(batches).astype(np.float32))
+
+    def test_load_leaves_unmanifested_lines_to_the_writer(self):
+        self._append(["/x/a"], self._rows(1))
+        # Another process's append in flight: paths written, manifest not yet.
+        with open(retrieval.PATH_FILE, "ab") as f:
+            f.write(b"/x/pending\n")
+        self._reload_from_disk()
+        self.assertEqual(retrieval._paths, ["/x/a"])
+        self.assertEqual(retrieval.PATH_FILE.read_bytes(), b"/x/a\n/x/pending\n")
+        # The next locked append writes from the manifest's offset.
+        self._append(["/x/b"], self._rows(1))
+        self.assertEqual(retrieval.PATH_FILE.read_bytes(), b"/x/a\n/x/b\n")
+        self._reload_from_disk()
+        self.assertEqual(retrieval._paths, ["/x/a", "/x/b"])
+
+    def test_append_reloads_rows_written_by_another_process(self):
+        self._append(["/x/a"], self._rows(1))
+        stale_manifest = retrieval._manifest
+        self._append(["/x/b"], self._rows(1))
+        # This process still holds the one-shard view; the locked reload
+        # picks up the second shard before appending a third.
+        retrieval._set_cache(stale_manifest, ["/x/a"], len(b"/x/a\n"))
+        retrieval._manifest_stamp = None
+        self._append(["/x/c"], self._rows(1))
+        self._reload_from_disk()
+        self.assertEqual(retrieval._paths, ["/x/a", "/x/b", "/x/c"])
+
+    def test_migrates_legacy_cache(self):
+        rows = self._rows(2).astype(np.float32)
+        np.save(retrieval.LEGACY_EMB_FILE, rows)
+        retrieval.LEGACY_PATH_FILE.write_bytes(orjson.dumps(["/x/./a.jpg", "/x/b.jpg"]))
+        self._reload_from_disk()
+        self.assertEqual(retrieval._paths, [os.path.abspath("/x/a.jpg"), os.path.abspath("/x/b.jpg")])
+        self.assertFalse(retrieval.LEGACY_PATH_FILE.exists())
+        self.assertFalse(retrieval.LEGACY_EMB_FILE.exists())
+        self.assertEqual(orjson.loads(retrieval.MANIFEST_FILE.read_bytes()),
+                         [{"file": "shard_000000.npy", "start": 0, "count": 2}])
+        np.testing.assert_array_equal(self._cached(retrieval._paths), rows)
+
+    def test_corrupt_manifest_resets(self):
+        self._append(["/x/a"], self._rows(1))
+        retrieval.MANIFEST_FILE.write_bytes(orjson.dumps([{"file": "shard_000000.npy", "start": 0,
+                                                           "count": 5}]))
+        self._reload_from_disk()
+        self.assertEqual(retrieval._paths, [])
+        self.assertIsNone(retrieval._manifest_stamp)  # retried before the next append
+        self._append(["/x/b"], self._rows(1))
+        self._reload_from_disk()
+        self.assertEqual(retrieval._paths, ["/x/b"])
+
+
+if __name__ == "__main__":
+    unittest.main()